@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as 
+#   published by the Free Software Foundation.
+
+# Times feedparser_builtin's date parsing over date strings in the formats
+# found in real feeds, the way a feed of 1000 entries (by default) would
+# parse them: trying every handler in order (as before), trying the handler
+# memoised for the field first, with the parsed string cache on top, and
+# refetching the same feed, where every string is already cached.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto import feedparser_builtin as fp
+import time
+import sys
+
+# One template per format, with the day, hour and minute filled in. Most
+# feeds only use one format.
+
+FORMATS = [
+    ("rfc822",      u"%(wday)s, %(day)02d Sep 2010 %(hour)02d:%(min)02d:00 GMT"),
+    ("rfc822 tz",   u"%(wday)s, %(day)d Sep 2010 %(hour)02d:%(min)02d:12 -0400"),
+    ("w3dtf",       u"2010-09-%(day)02dT%(hour)02d:%(min)02d:00Z"),
+    ("w3dtf frac",  u"2010-09-%(day)02dT%(hour)02d:%(min)02d:00.123+02:00"),
+    ("iso8601",     u"201009%(day)02dT%(hour)02d%(min)02d00Z"),
+    ("mssql",       u"2010-09-%(day)02d %(hour)02d:%(min)02d:58.0"),
+    ("hungarian",   u"2010-szeptember-%(day)02dT%(hour)d:%(min)02d-05:00"),
+    ("greek",       u"Κυρ, %(day)02d Σεπ 2010 %(hour)02d:%(min)02d:00 EST"),
+]
+
+WDAYS = ["Wed", "Thu", "Fri", "Sat", "Sun", "Mon", "Tue"]
+
+# Entries are spread over a few days, and often several are published in the
+# same minute, so some strings repeat.
+
+def corpus(template, n):
+    dates = []
+    for i in xrange(n):
+        m = ((i / 3) * 7) % (3 * 24 * 60)
+        day = 1 + m / (24 * 60)
+        dates.append(template % { "wday" : WDAYS[(day - 1) % 7], "day" : day,
+            "hour" : (m / 60) % 24, "min" : m % 60 })
+    return dates
+
+# The way _parse_date worked before handlers were memoised and strings cached.
+
+def chain(s):
+    for handler in fp._date_handlers:
+        try:
+            parsed = handler(s)
+            if not parsed:
+                continue
+            if len(parsed) != 9:
+                raise ValueError
+            map(int, parsed)
+            return parsed
+        except Exception:
+            pass
+    return None
+
+def memo_only(dates):
+    memo = {}
+    r = []
+    for s in dates:
+        fp._date_cache.clear()
+        r.append(fp._parse_date(s, memo, "updated"))
+    return r
+
+def memo_cache(dates):
+    fp._date_cache.clear()
+    memo = {}
+    return [ fp._parse_date(s, memo, "updated") for s in dates ]
+
+def refetch(dates):
+    memo = {}
+    return [ fp._parse_date(s, memo, "updated") for s in dates ]
+
+def timed(f, *args):
+    start = time.time()
+    r = f(*args)
+    return (time.time() - start, r)
+
+if __name__ == "__main__":
+    n = 1000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+
+    print "%-12s %10s %10s %10s %10s %8s" % ("format", "chain", "memo",
+            "+cache", "refetch", "speedup")
+    for name, template in FORMATS:
+        dates = corpus(template, n)
+        t_chain, r_chain = timed(lambda: [ chain(s) for s in dates ])
+        t_memo, r_memo = timed(memo_only, dates)
+        t_cache, r_cache = timed(memo_cache, dates)
+        t_refetch, r_refetch = timed(refetch, dates)
+
+        if r_chain != r_memo or r_chain != r_cache or r_chain != r_refetch:
+            print "%s: results differ!" % name
+        if None in r_chain:
+            print "%s: unparsed dates!" % name
+
+        us = lambda t: "%8.1fus" % (t * 1000000 / n)
+        print "%-12s %10s %10s %10s %10s %7.1fx" % (name, us(t_chain),
+                us(t_memo), us(t_cache), us(t_refetch), t_chain / t_cache)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as 
+#   published by the Free Software Foundation.
+
+# Times the in-memory half of a Feed() update, extend() from freshly loaded
+# entries, the state_delta()/apply_states() the interface sends the worker, the
+# delta()/apply_delta() it gets back, and todisk()'s state matching, on
+# synthetic feeds from 50 to 50,000 entries. Since all of these are keyed by id
+# or sid, the time per entry should stay flat as the feed grows.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto.feed import Feed
+from canto.const import STORY_QD
+import copy
+import time
+import sys
+
+class BenchCfg:
+    precache = []
+    state_change_hook = None
+
+def entries(n):
+    return [{ "id" : u"urn:bench:%d" % i,
+              "title" : u"Story %d" % i,
+              "link" : u"http://bench.invalid/%d" % i,
+              "canto_state" : [u"Bench", u"*"] } for i in xrange(n)]
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+def feed():
+    return Feed(BenchCfg(), "/nonexistent", u"http://bench.invalid/",
+            [u"Bench"], 5, 0, None, None, None)
+
+def send(f, w):
+    states = f.state_delta()
+    for s in f.changed():
+        s.updated = STORY_QD
+    w.apply_states(states)
+
+def reply(f, w, prev):
+    f.apply_delta(w.delta(prev))
+
+def bench(n):
+    w = feed()
+
+    # First load in the worker, then an update where every entry is already
+    # known, and the interface's copy of the result.
+    times = [timed(w.extend, entries(n)), timed(w.extend, entries(n))]
+    f = feed()
+    f.apply_delta(w.delta([]))
+
+    # The worker is killed once it's idle, and forked from the interface
+    # again on the next refresh, so its copy is the interface's.
+    w = copy.deepcopy(f)
+
+    # Every story's state changed in the interface, sent to the worker.
+    for s in f:
+        s.set("marked")
+    times.append(timed(send, f, w))
+
+    # The worker's update finds a tenth of the feed is new, and replies with
+    # the new stories and order, as well as the states it just took.
+    prev = w[:]
+    w.extend(entries(n + n / 10)[n / 10:])
+    times.append(timed(reply, f, w, prev))
+
+    # todisk can't actually write to /nonexistent, but matching every story
+    # against the on-disk states is the part that matters.
+    for s in f:
+        s.set("read")
+    states = dict([(e["id"], e["canto_state"]) for e in entries(n)])
+    times.append(timed(f.todisk, states))
+
+    return times
+
+if __name__ == "__main__":
+    sizes = [50, 500, 5000, 50000]
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+
+    print "%8s %10s %10s %10s %10s %10s %12s" % ("entries", "load",
+            "update", "send", "reply", "todisk", "us/entry")
+    for n in sizes:
+        t = bench(n)
+        print "%8d %9.1fms %9.1fms %9.1fms %9.1fms %9.1fms %12.2f" %\
+                (n, t[0] * 1000, t[1] * 1000, t[2] * 1000, t[3] * 1000,
+                        t[4] * 1000, sum(t) * 1000000 / n)
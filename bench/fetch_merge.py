@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as 
+#   published by the Free Software Foundation.
+
+# Times canto-fetch's merge of freshly fetched entries into the feed on disk
+# (FetchThread.merge_entries) for a never_discard feed that has accumulated a
+# large number of retained entries, 10,000 by default.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto.canto_fetch import FetchThread
+import time
+import sys
+
+class BenchCfg:
+    never_discard = ["unread"]
+    new_hook = None
+
+class BenchFeed:
+    URL = u"http://bench.invalid/"
+    tags = [u"Bench"]
+    keep = 40
+    rate = 5
+
+def entry(i, state=None):
+    e = { "id" : u"urn:bench:%d" % i,
+          "title" : u"Story %d" % i,
+          "link" : u"http://bench.invalid/%d" % i }
+    if state:
+        e["canto_state"] = state
+    return e
+
+def bench(retained, fetched=50, overlap=40):
+    t = FetchThread(BenchCfg(), BenchFeed(), "/nonexistent", "/nonexistent",
+            False, lambda x: None)
+
+    # The newest entries come first. Half of the retained entries are unread,
+    # so they're kept around by never_discard.
+
+    cur = { "entries" : [ entry(i, [u"Bench", u"*"] + ["read"] * (i % 2))\
+            for i in xrange(retained) ] }
+    new = [ entry(i) for i in xrange(overlap - fetched, overlap) ]
+
+    start = time.time()
+    entries, added = t.merge_entries(new, cur)
+    return time.time() - start, len(entries), len(added)
+
+if __name__ == "__main__":
+    sizes = [1000, 10000]
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+
+    print "%9s %10s %9s %6s" % ("retained", "merge", "written", "new")
+    for n in sizes:
+        elapsed, written, added = bench(n)
+        print "%9d %8.1fms %9d %6d" % (n, elapsed * 1000, written, added)
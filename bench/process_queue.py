@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Pushes a feed's worth of Story() objects through a process.Queue from a
+# forked process, like the worker process sends back a feed's stories when
+# they're first read, and times how long it takes to get() each copy of it on
+# the other side. Then bounces small requests off of a forked process that
+# waits on them like the worker does, and times the round trips.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto.process import Queue
+from canto.const import PROC_FLUSH, PROC_KILL
+from canto.story import Story
+from cPickle import dumps
+import time
+import sys
+import os
+
+def stories(n):
+    return [ Story({ "id" : u"urn:bench:%d" % i,
+                     "feed" : u"http://bench.invalid/",
+                     "title" : u"Story number %d of the benchmark feed" % i,
+                     "title_detail" : { "type" : u"text/plain",
+                         "language" : None, "value" : u"Story %d" % i,
+                         "base" : u"http://bench.invalid/" },
+                     "link" : u"http://bench.invalid/%d" % i,
+                     "updated_parsed" : 1262304000 + i,
+                     "canto_state" : [u"Bench", u"*"] }, "/nonexistent", 0)
+             for i in xrange(n) ]
+
+def bench(n, count):
+    feed = stories(n)
+    size = len(dumps(feed, 2))
+
+    q = Queue()
+    pid = os.fork()
+    if not pid:
+        for i in xrange(count):
+            q.put(feed)
+        q.close()
+        os._exit(0)
+
+    times = []
+    start = time.time()
+    for i in xrange(count):
+        while True:
+            try:
+                r = q.get(True, 1000)
+                break
+            except:
+                continue
+        if len(r) != n:
+            raise Exception, "Got %d stories, expected %d" % (len(r), n)
+        now = time.time()
+        times.append(now - start)
+        start = now
+
+    os.waitpid(pid, 0)
+    q.close()
+    return (size, times)
+
+def get(q):
+    while True:
+        try:
+            return q.get(True, 0.1)
+        except:
+            continue
+
+def latency(count):
+    request, reply = Queue(), Queue()
+    pid = os.fork()
+    if not pid:
+        while True:
+            r = get(request)
+            reply.put(r)
+            if r == (PROC_KILL, ):
+                reply.close()
+                os._exit(0)
+
+    times = []
+    for i in xrange(count):
+        start = time.time()
+        request.put((PROC_FLUSH, ))
+        get(reply)
+        times.append(time.time() - start)
+
+        # Give the sender threads time to go idle.
+        time.sleep(0.05)
+
+    request.put((PROC_KILL, ))
+    get(reply)
+    request.close()
+    os.waitpid(pid, 0)
+    return times
+
+if __name__ == "__main__":
+    sizes = [100, 1000, 10000]
+    count = 10
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+
+    print "%8s %10s %10s %10s %10s" % ("stories", "size", "first",
+            "median", "MB/s")
+    for n in sizes:
+        size, times = bench(n, count)
+        median = sorted(times[1:])[len(times[1:]) / 2]
+        print "%8d %9.1fM %9.1fms %9.1fms %10.1f" % (n, size / 1048576.0,
+                times[0] * 1000, median * 1000, size / 1048576.0 / median)
+
+    times = sorted(latency(20))
+    print
+    print "round trip: %.2fms median, %.2fms max" %\
+            (times[len(times) / 2] * 1000, times[-1] * 1000)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Compares a FeedStore() with and without compressed cold fields, on synthetic
+# feeds of HTML articles. For each, reports the size of the entries on disk,
+# the time to save() the feed, to load() every entry in full (what canto-fetch
+# does), to load() just the hot fields (what Feed.update does), and to read
+# every entry's content the way Story does.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto import store
+import tempfile
+import random
+import shutil
+import time
+import sys
+import os
+
+WORDS = ("the of and to in is that for it as was with be by on not he this "
+        "are or his from at which but have an they you were her she there "
+        "kernel release patch driver support network memory update security "
+        "browser version project developers community feature performance "
+        "server client protocol database interface library system").split()
+
+def paragraph(rand):
+    words = [ rand.choice(WORDS) for i in xrange(rand.randint(40, 120)) ]
+    for i in xrange(0, len(words), 17):
+        words[i] = u'<a href="http://bench.invalid/%s">%s</a>' %\
+                (words[i], words[i])
+    return u"<p>" + u" ".join(words) + u"</p>"
+
+def entries(n):
+    rand = random.Random(n)
+    r = []
+    for i in xrange(n):
+        html = u"\n".join([ paragraph(rand) for p in xrange(rand.randint(3, 12))])
+        r.append({ "id" : u"urn:bench:%d" % i,
+                   "title" : u"Story %d" % i,
+                   "link" : u"http://bench.invalid/%d" % i,
+                   "canto_state" : [u"Bench", u"*"],
+                   "summary" : html[:500],
+                   "summary_detail" : { "type" : u"text/html",
+                       "language" : None, "base" : u"http://bench.invalid/",
+                       "value" : html[:500] },
+                   "content" : [{ "type" : u"text/html", "language" : None,
+                       "base" : u"http://bench.invalid/", "value" : html }]})
+    return r
+
+def disk_size(path):
+    d = path + "/entries/"
+    return sum([ os.path.getsize(d + f) for f in os.listdir(d) ])
+
+def timed(fn, *args):
+    start = time.time()
+    r = fn(*args)
+    return (time.time() - start, r)
+
+def read_all(s, ids):
+    for id in ids:
+        entry = s.get_entry(id)
+        store.find_key(entry, "content")
+
+def bench(n, compress):
+    path = tempfile.mkdtemp() + "/feed"
+    cold_size = store.COLD_SIZE
+    if not compress:
+        store.COLD_SIZE = sys.maxint
+    try:
+        s = store.FeedStore(path)
+        ufp = { "feed" : {}, "canto_state" : [], "canto_update" : 0,
+                "entries" : entries(n) }
+        t_save, r = timed(s.save, ufp)
+        t_load, loaded = timed(s.load)
+        t_hot, r = timed(s.load, [])
+        t_read, r = timed(read_all, s, [ e["id"] for e in loaded["entries"] ])
+        return (disk_size(path), t_save, t_load, t_hot, t_read)
+    finally:
+        store.COLD_SIZE = cold_size
+        shutil.rmtree(os.path.dirname(path))
+
+if __name__ == "__main__":
+    sizes = [100, 1000, 5000]
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+
+    print "%8s %6s %10s %7s %10s %10s %10s %10s" % ("entries", "", "size",
+            "ratio", "save", "load", "hot", "read")
+    for n in sizes:
+        plain = bench(n, False)
+        for name, r in [("plain", plain), ("zlib", bench(n, True))]:
+            print "%8d %6s %9.1fM %6.1fx %9.1fms %9.1fms %9.1fms %9.1fms" %\
+                    (n, name, r[0] / 1048576.0, float(plain[0]) / r[0],
+                            r[1] * 1000, r[2] * 1000, r[3] * 1000,
+                            r[4] * 1000)
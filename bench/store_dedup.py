@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Measures how much sharing entries' text between feeds saves. A number of
+# synthetic feeds are saved, each carrying some fraction of articles that are
+# also in every other feed (with their own ids and bases, like a site's main
+# feed and its category feeds), and the space they'd take on their own is
+# compared with what they actually take on disk. Then every feed is trimmed
+# to half of its entries, and finally all of them are removed (and the blobs
+# pruned, as canto-fetch does), to check that the shared text is released
+# along the way.
+#
+# Run against an installed canto, e.g. with the PYTHONPATH runhere.sh sets up.
+
+from canto import store
+import tempfile
+import random
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from store_compress import paragraph
+
+def article(rand):
+    return u"\n".join([ paragraph(rand) for p in xrange(rand.randint(3, 12)) ])
+
+def entries(feed, n, shared, overlap, rand):
+    r = []
+    for i in xrange(n):
+        if i < len(shared):
+            html = shared[i]
+        else:
+            html = article(rand)
+        base = u"http://bench.invalid/%d/" % feed
+        r.append({ "id" : u"urn:bench:%d:%d" % (feed, i),
+                   "title" : u"Story %d" % i,
+                   "link" : base + unicode(i),
+                   "canto_state" : [u"Bench", u"*"],
+                   "summary" : html[:600],
+                   "summary_detail" : { "type" : u"text/html",
+                       "language" : None, "base" : base,
+                       "value" : html[:600] },
+                   "content" : [{ "type" : u"text/html", "language" : None,
+                       "base" : base, "value" : html }]})
+    return r
+
+# Returns (bytes counting every link separately, bytes actually used).
+
+def usage(path):
+    apparent = 0
+    inodes = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            if root.endswith(".blobs"):
+                continue
+            apparent += st.st_size
+            inodes[st.st_ino] = st.st_size
+    for name in os.listdir(store.blob_dir(path)):
+        st = os.stat(store.blob_dir(path) + name)
+        inodes[st.st_ino] = st.st_size
+    return (apparent, sum(inodes.values()))
+
+def report(what, path):
+    apparent, actual = usage(path)
+    print "%-10s %9.1fM %9.1fM %7.1f%% %7d" % (what, apparent / 1048576.0,
+            actual / 1048576.0, 100 - actual * 100.0 / apparent,
+            len(os.listdir(store.blob_dir(path))))
+
+def bench(feeds, n, overlap):
+    rand = random.Random(feeds * n)
+    shared = [ article(rand) for i in xrange(int(n * overlap)) ]
+    path = tempfile.mkdtemp()
+    try:
+        stores = [ store.FeedStore(path + "/feed%d" % f) for f in xrange(feeds) ]
+        ufps = []
+        for f, s in enumerate(stores):
+            ufps.append({ "feed" : {}, "canto_state" : [], "canto_update" : 0,
+                "entries" : entries(f, n, shared, overlap, rand) })
+            s.save(ufps[-1])
+        report("saved", path)
+
+        for s, ufp in zip(stores, ufps):
+            ufp["entries"] = ufp["entries"][:n / 2]
+            s.save(ufp)
+        report("trimmed", path)
+
+        for s in stores:
+            store.remove(s.path)
+        store.prune_blobs(path)
+        print "%-10s %39d" % ("removed", len(os.listdir(store.blob_dir(path))))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    feeds, n, overlap = 4, 500, 0.3
+    if len(sys.argv) > 1:
+        feeds, n, overlap = int(sys.argv[1]), int(sys.argv[2]),\
+                float(sys.argv[3])
+
+    print "%d feeds of %d entries, %d%% shared" % (feeds, n, overlap * 100)
+    print "%-10s %10s %10s %8s %7s" % ("", "apparent", "actual", "saved",
+            "blobs")
+    bench(feeds, n, overlap)
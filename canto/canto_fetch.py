@@ -10,9 +10,12 @@
 # conveniently fit into a single file without there being too much confusion.
 
 # There are three parts, roughly.
-# main()        -> arg parsing and (if necessary) runs the daemon loop
-# run()         -> spawns the appropriate threads
-# FetchThread   -> performs the update for one feed
+# main()        -> arg parsing and (if necessary) runs the daemon loop, which
+#                  runs feeds as they come due on the Schedule()
+# run()         -> queues up every feed on a FetchPool
+# FetchPool     -> a fixed number of worker threads that run FetchThreads
+# FetchThread   -> performs the update for one feed, optionally handing the
+#                  parsing and merging off to a process pool
 
 # main is only used when canto-fetch is called from the command line.
 # run is used internally by canto when it needs to invoke an update.
@@ -23,15 +26,20 @@ feedparser = feedparser_builtin
 
 from const import VERSION_TUPLE, GIT_SHA
 from cfg.base import get_cfg
+from store import FeedStore
+from schedule import Schedule
+import fetch_http
+import store
 import utility
 import args
 
-from threading import Thread
+from threading import Thread, Condition
+import multiprocessing
 import traceback
 import commands
+import hashlib
 import urlparse
 import urllib2
-import cPickle
 import locale
 import socket
 import signal
@@ -40,6 +48,11 @@ import time
 import sys
 import os
 
+# A feed that needed the loose parser is parsed with it straight away this many
+# times before the strict parser gets another chance.
+
+LOOSE_RETRY = 10
+
 def main(enc):
     conf_dir, log_file, conf_file, feed_dir, script_dir, optlist =\
         args.parse_common_args(enc,
@@ -103,16 +116,39 @@ def main(enc):
 
     # Remove any crap out of the directory. This is mostly for
     # cleaning up when the user has removed a feed from the configuration.
+    # Dot files are canto-fetch's own (like the .schedule).
 
     valid_names = [f.URL.replace("/"," ") for f in cfg.feeds]
     for file in os.listdir(cfg.feed_dir):
+        if file.startswith("."):
+            continue
         if not file in valid_names:
             log_func("Deleted extraneous file: %s" % file)
             try:
-                os.unlink(cfg.feed_dir + file)
+                store.remove(cfg.feed_dir + file)
             except:
                 pass
 
+    # Entries' text can be shared between feeds, so removing a feed can leave
+    # some of it unused.
+
+    try:
+        pruned = store.prune_blobs(cfg.feed_dir)
+        if pruned:
+            log_func("Pruned %d unused blobs" % pruned)
+    except:
+        pass
+
+    # Migrate any pre-0.7.11 feed pickles to the FeedStore() format in one go,
+    # rather than lazily as they're encountered.
+
+    for f in cfg.feeds:
+        try:
+            if FeedStore(f.path).upgrade():
+                log_func("Migrated %s" % f.URL)
+        except:
+            log_func("Failed to migrate %s" % f.URL)
+
     if background:
         # This is a pretty canonical way to do backgrounding.
 
@@ -137,19 +173,50 @@ def main(enc):
         os.close(2)
 
     if daemon:
+        # The connection pool outlives each run, so connections to the same
+        # hosts are reused from one update to the next.
+
+        conns = fetch_http.ConnectionPool()
+
+        # Rather than running every feed each interval, only to find that most
+        # of them aren't due, the daemon sleeps until the next feed is due and
+        # runs only the feeds that are. The schedule is kept on disk so that a
+        # restart doesn't have to open every feed to find out.
+
+        # The daemon still wakes up at least once per interval to reload the
+        # config.
+
+        schedule = Schedule(cfg.feed_dir + ".schedule", updateInterval)
+        schedule.load()
+
         while 1:
-            run(cfg, verbose, force)
-            time.sleep(updateInterval)
+            schedule.configure(cfg)
+            heap = schedule.heap(cfg.feeds, force)
+            if heap:
+                wait = min(heap[0][0] - time.time(), updateInterval)
+            else:
+                wait = updateInterval
+            if wait > 0:
+                time.sleep(wait)
+
+            due = schedule.pop_due(heap, time.time())
+            if due:
+                run(cfg, verbose, force, conns, due, schedule)
+
             oldcfg = cfg
             try :
                 cfg = get_cfg(conf_file, log_file, feed_dir, script_dir)
-                self.cfg.parse()
+                cfg.parse()
             except:
                 cfg = oldcfg
     else:
         sys.exit(run(cfg, verbose, force))
 
-def run(cfg, verbose=False, force=False):
+# If feeds is given, only those feeds are run. If schedule is given, it's
+# updated and saved with the results.
+
+def run(cfg, verbose=False, force=False, conns=None, feeds=None,\
+        schedule=None):
 
     # If we don't explicitly set this, feedparser/urllib will take *forever* to
     # give up on a connection. 30 is a pretty sane default, I think, considering
@@ -158,17 +225,47 @@ def run(cfg, verbose=False, force=False):
 
     socket.setdefaulttimeout(30)
 
-    threads = []
-
     def log_func(x):
         if verbose:
             print x
         cfg.log(x)
 
+    # Without a persistent connection pool, connections are only reused
+    # within this run.
+
+    persist = conns != None
+    if not persist:
+        conns = fetch_http.ConnectionPool()
+    prevstats = conns.stats()
+
+    # Parsing and merging are CPU bound, so they can be spread over a pool of
+    # processes, while the fetch threads just wait on the network. The pool
+    # has to be forked before any threads are started.
+
+    procs = None
+    if cfg.fetch_processes:
+        nprocs = cfg.fetch_processes
+        if type(nprocs) == bool:
+            nprocs = multiprocessing.cpu_count()
+        procs = multiprocessing.Pool(nprocs, init_worker, (cfg,))
+
+    pool = FetchPool(cfg.fetch_threads, cfg.fetch_host_limit, log_func)
+    start = time.time()
+
     def imdone():
-        for thread in threads:
-            thread.join()
+        pool.stop()
+        pool.join()
+        if procs:
+            procs.close()
+            procs.join()
+        if not persist:
+            conns.close()
         socket.setdefaulttimeout(None)
+
+        opened, reused = conns.stats()
+        log_func("Connections: %d opened, %d reused." %\
+                (opened - prevstats[0], reused - prevstats[1]))
+        log_func("Fetch cycle took %.2f seconds." % (time.time() - start))
         log_func("Gracefully exiting Canto-fetch.")
         return 1
 
@@ -177,27 +274,220 @@ def run(cfg, verbose=False, force=False):
     signal.signal(signal.SIGTERM, killme)
     signal.signal(signal.SIGINT, killme)
 
+    if feeds == None:
+        feeds = cfg.feeds
+
     # The main canto-fetch loop.
-    for fd in cfg.feeds:
+    jobs = []
+    for fd in feeds:
         fpath = cfg.feed_dir + fd.URL.replace("/", " ")
         spath = cfg.script_dir
-        threads.append(FetchThread(cfg, fd, fpath, spath, force, log_func))
-        threads[-1].start()
+        jobs.append(FetchThread(cfg, fd, fpath, spath, force, log_func, conns,
+            procs))
+        if schedule:
+            jobs[-1].rate = schedule.rate(fd)
+        pool.add(jobs[-1])
+
+    pool.start()
+    pool.join()
+
+    log_func("Encoding/parser cache: %d hits, %d misses." %\
+            (sum([ j.hint_hits for j in jobs ]),
+                sum([ j.hint_misses for j in jobs ])))
+
+    if schedule:
+        for job in jobs:
+            schedule.ran(job.fd, job.last_update, start, job.new_count)
+        schedule.prune(cfg.feeds)
+        try:
+            schedule.save()
+        except:
+            log_func("Failed to save schedule.")
 
     imdone()
     return 0
 
+# The FetchPool runs FetchThreads on a fixed number of worker threads, instead
+# of starting a thread for every feed, which with a few hundred feeds meant
+# hundreds of simultaneous connections.
+
+# Feeds are taken in configuration order, except that no more than host_limit
+# feeds from the same host are fetched at once (0 means no limit). Script
+# feeds don't count against any host.
+
+class FetchPool():
+    def __init__(self, threads, host_limit, log_func):
+        self.threads = threads
+        self.host_limit = host_limit
+        self.log_func = log_func
+
+        self.cond = Condition()
+        self.pending = []
+        self.active = {}
+        self.workers = []
+
+    def host(self, job):
+        if job.fd.URL.startswith("script:"):
+            return None
+        netloc = urlparse.urlparse(job.fd.URL)[1].lower()
+        return netloc.split("@")[-1]
+
+    def add(self, job):
+        self.cond.acquire()
+        try:
+            self.pending.append(job)
+        finally:
+            self.cond.release()
+
+    # Next blocks until there's a job whose host isn't at its limit, or
+    # returns None if there's nothing left to do.
+
+    def next(self):
+        self.cond.acquire()
+        try:
+            while self.pending:
+                for i, job in enumerate(self.pending):
+                    host = self.host(job)
+                    if host == None or not self.host_limit or\
+                            self.active.get(host, 0) < self.host_limit:
+                        break
+                else:
+                    self.cond.wait()
+                    continue
+
+                del self.pending[i]
+                if host != None:
+                    self.active[host] = self.active.get(host, 0) + 1
+                return job
+            return None
+        finally:
+            self.cond.release()
+
+    def done(self, job):
+        self.cond.acquire()
+        try:
+            host = self.host(job)
+            if host != None:
+                self.active[host] -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def work(self):
+        while 1:
+            job = self.next()
+            if not job:
+                break
+            try:
+                job.run()
+            except:
+                self.log_func("Exception fetching %s : %s" %\
+                        (job.fd.URL, traceback.format_exc()))
+            finally:
+                self.done(job)
+
+    def start(self):
+        for i in xrange(min(self.threads, len(self.pending))):
+            t = Thread(target=self.work)
+            t.start()
+            self.workers.append(t)
+
+    # Drop any feeds that haven't been started yet. The running ones are
+    # allowed to finish so nothing is left half written.
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.pending = []
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    # Join with a timeout, otherwise the main thread sits in an
+    # uninterruptible wait and SIGINT/SIGTERM are never handled.
+
+    def join(self):
+        for t in self.workers:
+            while t.isAlive():
+                t.join(1)
+
+# The process pool's workers get the config when they're forked, instead of
+# having it pickled (it's full of user functions), and ignore signals, the
+# parent shuts them down once the fetch threads are done.
+
+worker_cfg = None
+
+def init_worker(cfg):
+    global worker_cfg
+    worker_cfg = cfg
+
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Process_feed runs FetchThread.process() in a worker. Only the raw feed goes
+# in, and only the log messages and the bits of state that the fetch thread
+# needs come back.
+
+def process_feed(task):
+    URL, tags, base_set, force, data, frozen, digest, prev_update = task
+
+    cfg = worker_cfg
+    fd = [ f for f in cfg.feeds if f.URL == URL ][0]
+    fd.tags = tags
+    fd.base_set = base_set
+
+    log = []
+    job = FetchThread(cfg, fd, cfg.feed_dir + URL.replace("/", " "),
+            cfg.script_dir, force, log.append)
+    job.last_update = prev_update
+    job.process(data, fetch_http.thaw(data, frozen), digest, prev_update)
+
+    return { "log" : log,
+            "tags" : fd.tags,
+            "base_set" : fd.base_set,
+            "last_update" : job.last_update,
+            "new_count" : job.new_count,
+            "hint_hits" : job.hint_hits,
+            "hint_misses" : job.hint_misses }
+
 class FetchThread(Thread):
-    def __init__(self, cfg, fd, fpath, spath, force, log_func):
+    def __init__(self, cfg, fd, fpath, spath, force, log_func, conns=None,\
+            procs=None):
         Thread.__init__(self)
         self.fd = fd
+        self.conns = conns
+        self.procs = procs
         self.fpath = fpath
+        self.store = FeedStore(fpath)
         self.spath = spath
         self.force = force
         self.cfg = cfg
         self.log_func = log_func
         self.prevtime = 0
 
+        # The canto_update of the feed on disk once the thread is done, so
+        # the daemon can tell when it's next due.
+
+        self.last_update = 0
+
+        # The number of new items found, if the feed was actually fetched,
+        # for adaptive rates.
+
+        self.new_count = None
+
+        # Why parsing was stopped early, if it was ("known" or "keep").
+
+        self.stopped = None
+
+        # Encoding / parser cache hits and misses.
+
+        self.hint_hits = 0
+        self.hint_misses = 0
+
+        # The daemon may override the configured rate with a learned one.
+
+        self.rate = fd.rate
+
         # This emptyfeed forms a skeleton for any canto feed.
         # Canto_state is a place holder. Canto_update is the
         # last time the feed was updated, and canto_version is
@@ -209,29 +499,57 @@ class FetchThread(Thread):
         self.emptyfeed = {"canto_state":[], "entries":[], "canto_update":0,
                         "canto_version": VERSION_TUPLE }
 
+    # get_meta gets the store's meta, which is everything but the entries, and
+    # all that's needed to tell whether the feed is due and to fetch it.
+
+    def get_meta(self):
+        try:
+            self.store.upgrade()
+            if self.store.upgrade_schema():
+                self.log_func("Upgraded store format for %s" % self.fd.URL)
+        except:
+            self.log_func("Migration exception on %s" % self.fpath)
+
+        # Get_curfeed writes the stub for new feeds.
+        if not self.store.exists():
+            return self.get_curfeed()
+
+        meta = None
+        try:
+            self.store.lock(fcntl.LOCK_SH)
+            try:
+                meta = self.store.read_meta()
+            finally:
+                self.store.unlock()
+        except:
+            self.log_func("Store meta exception on %s" % self.fpath)
+
+        return meta or self.emptyfeed
+
     # get_curfeed loads the old feed data from disk. It blocks getting the lock,
     # so it could take awhile, but should never fail if the information isn't
     # corrupted.
 
     def get_curfeed(self):
         curfeed = self.emptyfeed
-        if os.path.exists(self.fpath):
-            if os.path.isfile(self.fpath):
-                f = open(self.fpath, "r")
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        try:
+            self.store.upgrade()
+        except:
+            self.log_func("Migration exception on %s" % self.fpath)
 
-                self.prevtime = os.stat(self.fpath).st_mtime
+        if self.store.exists():
+            self.store.lock(fcntl.LOCK_SH)
+            self.prevtime = self.store.stamp()
 
-                try:
-                    curfeed = cPickle.load(f)
-                except:
-                    self.log_func("cPickle load exception on %s" % self.fpath)
-                finally:
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                    f.close()
+            try:
+                curfeed = self.store.load() or curfeed
+            except:
+                self.log_func("Store load exception on %s" % self.fpath)
+            finally:
+                self.store.unlock()
         else:
 
-            # The file doesn't exist yet, so we write a stub so that Canto
+            # The store doesn't exist yet, so we write a stub so that Canto
             # detects presence and doesn't endlessly try to refetch error'd
             # feeds if later on an error occurs.
 
@@ -244,26 +562,156 @@ class FetchThread(Thread):
                 }
 
             curfeed["entries"].append(d)
-            f = open(self.fpath, "w")
             try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                cPickle.dump(curfeed, f)
-                f.flush()
+                self.store.create()
+                self.store.lock(fcntl.LOCK_EX)
+                try:
+                    self.store.save(curfeed)
+                finally:
+                    self.store.unlock()
             except:
                 pass
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
 
         return curfeed
 
-    def run(self):
-        curfeed = self.get_curfeed()
+    # open performs the actual request. Every opener gets a CompressionHandler,
+    # so all fetches, authenticated or not, negotiate gzip/deflate, and, if
+    # there's a connection pool, a KeepAliveHandler.
+
+    def open(self, request):
+        handlers = [fetch_http.CompressionHandler()]
+        if self.conns:
+            handlers.append(fetch_http.KeepAliveHandler(self.conns))
+
+        # Feed with no password.
+        if not (self.fd.username or self.fd.password):
+            return urllib2.build_opener(*handlers).open(request)
+
+        # Feed from URL w/ password
+        mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        domain = urlparse.urlparse(self.fd.URL)[1]
+        mgr.add_password(None, domain, self.fd.username, self.fd.password)
+
+        # First, we try Basic Authentication
+        try:
+            auth = fetch_http.BasicAuthHandler(mgr)
+            return urllib2.build_opener(*(handlers + [auth])).open(request)
+        except Exception, e:
+            if getattr(e, "code", None) == 304:
+                raise
+            fetch_http.discard(e)
+
+        # And, failing that, try Digest Authentication
+        auth = fetch_http.DigestAuthHandler(mgr)
+        return urllib2.build_opener(*(handlers + [auth])).open(request)
+
+    # not_modified handles a 304, or a body identical to the last one. The
+    # only thing that changes is the update time, which is in the store's
+    # fetched file, so the rest of the store isn't touched at all.
+
+    def not_modified(self, reason="not modified"):
+        self.log_func("%s %s" % (self.fd.URL, reason))
+        try:
+            self.store.lock(fcntl.LOCK_EX)
+            try:
+                meta = self.store.read_meta()
+                fetched = dict([ (k, meta[k]) for k in store.FETCH_KEYS\
+                        if k in meta ])
+                fetched["canto_update"] = time.time()
+                self.last_update = fetched["canto_update"]
+                self.new_count = 0
+                self.store.write_fetched(fetched)
+            finally:
+                self.store.unlock()
+        except:
+            self.log_func("Store meta exception on %s" % self.fpath)
 
+    # merge_entries takes the freshly fetched entries and the current feed on
+    # disk and returns the entries to write, along with the genuinely new ones.
+    # Everything is matched up by id through dicts, so this is linear in the
+    # size of both feeds, even for huge never_discard feeds.
+
+    def merge_entries(self, fetched, curfeed):
+        # Broken feeds can have duplicate ids, each fetched duplicate is
+        # matched with the next current entry with that id.
+
+        current = {}
+        for centry in curfeed["entries"]:
+            current.setdefault(centry["id"], []).append(centry)
+
+        # Make item state persistent. Matched entries are recorded so that
+        # later they're not candidates for being appended to the end of the
+        # feed.
+
+        new = []
+        matched = {}
+        for entry in fetched:
+            if current.get(entry["id"]):
+                centry = current[entry["id"]].pop(0)
+                entry["canto_state"] = centry["canto_state"]
+                matched[id(centry)] = 1
+            else:
+                new.append(entry)
+
+            # Apply default state to genuinely new items.
+            if "canto_state" not in entry:
+                entry["canto_state"] = self.fd.tags + [u"*"]
+
+        leftover = [ c for c in curfeed["entries"] if id(c) not in matched ]
+
+        # Tailor the list to the correct number of items. In canto < 0.7.0,
+        # you could specify a keep that was lower than the number of items in
+        # the feed. This was simply done, but ultimately it caused too much
+        # "bounce" for social news feeds. Items get put into the feed, are
+        # upvoted enough to be within the first n items, you change their
+        # state, they move out of the first n items, are forgotten, then are
+        # upvoted again into the first n item and (as far as c-f knows) are
+        # treated like brand new items.
+
+        # This will still be a problem if items get taken out of the feed and
+        # put back into the feed (and the item isn't in the extra kept items),
+        # but then it becomes a site problem, not a reader problem.
+
+        # If parsing stopped at known entries, the rest of the feed wasn't
+        # seen, but it's presumably what's already on disk, so those are kept
+        # as well, up to the size the feed was when it was last parsed in full
+        # (see process()). Anything past that is up to never_discard, as
+        # usual.
+
+        entries = fetched[:]
+        kept = 0
+        keep = self.fd.keep
+        if self.stopped == "known":
+            keep = max(keep, curfeed.get("canto_hints", {}).get("size", 0))
+        if keep and len(entries) < keep:
+            kept = keep - len(entries)
+            entries += leftover[:kept]
+
+        # Enforce the "never_discard" setting. We iterate through the stories
+        # and then the tag so that feed order is preserved.
+
+        if self.cfg.never_discard:
+            for e in leftover[kept:]:
+                for tag in self.cfg.never_discard:
+                    if tag == "unread":
+                        if "read" in e["canto_state"]:
+                            continue
+                    elif tag not in e["canto_state"]:
+                        continue
+                    entries.append(e)
+                    break
+
+        return (entries, new)
+
+    def run(self):
         # Determine whether it's been long enough between
-        # updates to warrant refetching the feed.
+        # updates to warrant refetching the feed. This only needs the
+        # store's meta, so feeds that aren't due are never loaded.
+
+        meta = self.get_meta()
+        self.last_update = meta["canto_update"]
 
-        if time.time() - curfeed["canto_update"] < self.fd.rate * 60 and\
+        if time.time() - self.last_update < self.rate * 60 and\
                 not self.force:
             return
 
@@ -271,8 +719,8 @@ class FetchThread(Thread):
         # it out of the previously downloaded info.
 
         if not self.fd.base_set:
-            if "feed" in curfeed and "title" in curfeed["feed"]:
-                replace = lambda x: x or curfeed["feed"]["title"]
+            if "feed" in meta and "title" in meta["feed"]:
+                replace = lambda x: x or meta["feed"]["title"]
                 self.fd.tags = [ replace(x) for x in self.fd.tags]
                 self.fd.base_set = 1
                 self.log_func("Updating %s" % self.fd.tags[0])
@@ -284,14 +732,15 @@ class FetchThread(Thread):
         else:
             self.log_func("Updating %s" % self.fd.tags[0])
 
-        # This block set newfeed to a parsed feed.
+        # This block sets data to the raw feed, and source to something
+        # feedparser can parse.
 
         try:
             # Feed from script
             if self.fd.URL.startswith("script:"):
                 script = self.spath + "/" + self.fd.URL[7:]
-                out = commands.getoutput(script)
-                newfeed = feedparser.parse(out)
+                data = commands.getoutput(script)
+                source = data
             # Feed from URL
             else:
                 request = urllib2.Request(self.fd.URL)
@@ -299,28 +748,38 @@ class FetchThread(Thread):
                     "Canto/%d.%d.%d + http://codezen.org/canto" %\
                     VERSION_TUPLE)
 
-                # Feed from URL w/ password
-                if self.fd.username or self.fd.password:
-                    mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                    domain = urlparse.urlparse(self.fd.URL)[1]
-                    mgr.add_password(None, domain,\
-                            self.fd.username, self.fd.password)
-
-                    # First, we try Basic Authentication
-                    auth = urllib2.HTTPBasicAuthHandler(mgr)
-                    opener = urllib2.build_opener(auth)
-                    try:
-                        newfeed = feedparser.parse(opener.open(request))
-                    except:
-                        # And, failing that, try Digest Authentication
-                        auth = urllib2.HTTPDigestAuthHandler(mgr)
-                        opener = urllib2.build_opener(auth)
-                        newfeed = feedparser.parse(opener.open(request))
-                # Feed with no password.
-                else:
-                    newfeed = feedparser.parse(\
-                            feedparser.urllib2.urlopen(request))
+                # Send the validators from the last fetch, if there are any,
+                # so the server can tell us nothing's changed with a 304.
+
+                if meta.get("canto_etag"):
+                    request.add_header('If-None-Match', meta["canto_etag"])
+                if meta.get("canto_modified"):
+                    request.add_header('If-Modified-Since',\
+                            meta["canto_modified"])
+
+                data, source = fetch_http.buffered(self.open(request))
+
+                stats = fetch_http.transfer_stats(source)
+                if stats:
+                    self.log_func("%s: %d bytes on wire, %d bytes of feed" %\
+                            (self.fd.URL, stats[0], stats[1]))
+
+            # Plenty of servers don't do conditional GETs, but send the exact
+            # same body every time. If it's the same as last time, there's no
+            # need to parse it at all.
+
+            digest = hashlib.sha1(data).hexdigest()
+            if digest == meta.get("canto_digest") and not self.force:
+                self.not_modified("unchanged")
+                return
         except:
+            # urllib2 raises a 304 as an HTTPError, but it just means the feed
+            # hasn't changed, so there's nothing to parse or write.
+
+            if getattr(sys.exc_info()[1], "code", None) == 304:
+                self.not_modified()
+                return
+
             # Generally an exception is a connection refusal, but in any
             # case we either won't get data or can't trust the data, so
             # just skip processing this feed.
@@ -331,6 +790,138 @@ class FetchThread(Thread):
 
             return
 
+        if self.procs:
+            self.remote_process(data, source, digest, meta["canto_update"])
+        else:
+            self.process(data, source, digest, meta["canto_update"])
+
+    # Entry_hook returns a function for feedparser to call on every entry as
+    # it's parsed, that tells it to stop once stop_after_known entries in a
+    # row are already on disk, or, with stop_after_keep, after the feed's keep
+    # entries. Feeds are newest first, so there's nothing new past there.
+
+    def entry_hook(self, curfeed):
+        known = dict([ (e["id"], 1) for e in curfeed["entries"] ])
+        counts = { "entries" : 0, "known" : 0 }
+
+        # Until the feed has been parsed in full once, its size isn't known, so
+        # merge_entries() couldn't tell how much of what's on disk to keep.
+        stop_known = self.cfg.stop_after_known
+        if not curfeed.get("canto_hints", {}).get("size"):
+            stop_known = 0
+
+        def hook(entry):
+            # The id ends up the same as process() makes it, where everything
+            # but the link has been through stripchars.
+
+            if "id" in entry or "link" not in entry:
+                id = entry.get("id", entry.get("title", None))
+                if type(id) in [unicode, str]:
+                    id = utility.stripchars(id)
+            else:
+                id = entry["link"]
+
+            counts["entries"] += 1
+            if id in known:
+                counts["known"] += 1
+            else:
+                counts["known"] = 0
+
+            if stop_known and counts["known"] >= stop_known:
+                self.stopped = "known"
+            elif self.cfg.stop_after_keep and self.fd.keep and\
+                    counts["entries"] >= self.fd.keep:
+                self.stopped = "keep"
+            return self.stopped
+        return hook
+
+    # Remote_process runs process() in the process pool, and picks up the
+    # results.
+
+    def remote_process(self, data, source, digest, prev_update):
+        task = (self.fd.URL, self.fd.tags, self.fd.base_set, self.force, data,
+                fetch_http.freeze(source), digest, prev_update)
+
+        result = self.procs.apply(process_feed, (task,))
+
+        for line in result["log"]:
+            self.log_func(line)
+        self.fd.tags = result["tags"]
+        self.fd.base_set = result["base_set"]
+        self.last_update = result["last_update"]
+        self.new_count = result["new_count"]
+        self.hint_hits = result["hint_hits"]
+        self.hint_misses = result["hint_misses"]
+
+    # Process does everything after the fetch: parsing, cleaning up, merging
+    # with the feed on disk and writing it out. Prev_update is the
+    # canto_update the fetch was based on.
+
+    def process(self, data, source, digest, prev_update):
+        curfeed = self.get_curfeed()
+
+        # Another canto-fetch updated the feed while this one was fetching.
+        if curfeed["canto_update"] != prev_update:
+            self.log_func("%s updated already, bailing" % self.fd.URL)
+            self.last_update = curfeed["canto_update"]
+            return
+
+        # Only the builtin feedparser can stop early, take hints about the
+        # encoding, parser and date formats that worked for this feed last
+        # time, or leave sanitizing to the client.
+
+        kwargs = {}
+        hints = curfeed.get("canto_hints", {})
+        if feedparser == feedparser_builtin:
+            if self.cfg.stop_after_known or self.cfg.stop_after_keep:
+                kwargs["entry_hook"] = self.entry_hook(curfeed)
+
+            kwargs["hints"] = { "encoding" : hints.get("encoding"),
+                    "dates" : hints.get("dates") }
+            kwargs["defer_html"] = self.cfg.defer_sanitize
+            if hints.get("loose", 0) < LOOSE_RETRY:
+                kwargs["hints"]["parser"] = hints.get("parser")
+
+        try:
+            newfeed = feedparser.parse(source, **kwargs)
+        except:
+            enc = locale.getpreferredencoding()
+            self.log_func("Exception trying to parse feed %s : %s" % \
+                    (self.fd.URL.encode(enc, "ignore"), sys.exc_info()[1]))
+            return
+
+        if self.stopped:
+            self.log_func("%s: stopped parsing after %d entries (%s)" %\
+                    (self.fd.URL, len(newfeed["entries"]), self.stopped))
+
+        # Remember what worked for next time. Loose counts how many times in a
+        # row the loose parser was used because of the hint. Size is how many
+        # entries the feed had when it was last parsed in full.
+
+        outcomes = newfeed.get("hints", {})
+        for kind in outcomes:
+            if outcomes[kind] == "hit":
+                self.hint_hits += 1
+            else:
+                self.hint_misses += 1
+            self.log_func("%s: %s cache %s" % (self.fd.URL, kind, outcomes[kind]))
+
+        loose = 0
+        if outcomes.get("parser") == "hit":
+            loose = hints.get("loose", 0) + 1
+        size = len(newfeed["entries"])
+        if self.stopped:
+            size = hints.get("size", 0)
+        hints = { "encoding" : newfeed.get("encoding") or None,
+                "parser" : newfeed.get("parser"),
+                "dates" : newfeed.get("date_handlers"),
+                "loose" : loose,
+                "size" : size }
+
+        for key in ["hints", "parser", "date_handlers", "stopped"]:
+            if key in newfeed:
+                del newfeed[key]
+
         # I don't know why feedparser doesn't actually throw this
         # since all URLErrors are basically unrecoverable.
 
@@ -384,6 +975,15 @@ class FetchThread(Thread):
         newfeed["canto_state"] = curfeed["canto_state"]
         newfeed["canto_update"] = time.time()
 
+        # Keep the validators for the next conditional GET. These are the raw
+        # header values, since they're supposed to be sent back verbatim.
+
+        headers = newfeed.get("headers", {})
+        newfeed["canto_etag"] = headers.get("etag", None)
+        newfeed["canto_modified"] = headers.get("last-modified", None)
+        newfeed["canto_digest"] = digest
+        newfeed["canto_hints"] = hints
+
         # We can set this here, without checking curfeed.
         # Any migration should be done in the get_curfeed function,
         # when the old data is first loaded.
@@ -404,6 +1004,10 @@ class FetchThread(Thread):
                 if subitem in entry:
                     for e in entry[subitem]:
                         for k in e.keys():
+                            # The base is never displayed, only used to
+                            # resolve relative links (see Story.sanitize).
+                            if k == "base":
+                                continue
                             if type(e[k]) in [unicode,str]:
                                 e[k] = utility.stripchars(e[k])
 
@@ -423,86 +1027,35 @@ class FetchThread(Thread):
                 else:
                     entry["id"] = None
 
-        # Then search through the current feed to
-        # make item state persistent, and loop until
-        # it's safe to update on disk.
+        # Then merge with the current feed to make item state persistent, and
+        # loop until it's safe to update on disk. The fetched entries are kept
+        # aside so that a retry starts over from them.
 
-        new = []
+        fetched = newfeed["entries"]
         while 1:
-            for entry in newfeed["entries"]:
-                for centry in curfeed["entries"]:
-                    if entry["id"] == centry["id"]:
-                        entry["canto_state"] = centry["canto_state"]
-                        
-                        # The entry is removed so that later it's
-                        # not a candidate for being appended to the
-                        # end of the feed.
-
-                        curfeed["entries"].remove(centry)
-                        break
-                else:
-                    new.append(entry)
-
-                # Apply default state to genuinely new items.
-                if "canto_state" not in entry:
-                    entry["canto_state"] = self.fd.tags + [u"*"]
-
-            # Tailor the list to the correct number of items. In canto < 0.7.0,
-            # you could specify a keep that was lower than the number of items
-            # in the feed. This was simply done, but ultimately it caused too
-            # much "bounce" for social news feeds. Items get put into the feed,
-            # are upvoted enough to be within the first n items, you change
-            # their state, they move out of the first n items, are forgotten,
-            # then are upvoted again into the first n item and (as far as c-f
-            # knows) are treated like brand new items.
-
-            # This will still be a problem if items get taken out of the feed
-            # and put back into the feed (and the item isn't in the extra kept
-            # items), but then it becomes a site problem, not a reader problem.
-
-            if self.fd.keep and len(newfeed["entries"]) < self.fd.keep:
-                newfeed["entries"] += curfeed["entries"]\
-                        [:self.fd.keep - len(newfeed["entries"])]
-
-            # Enforce the "never_discard" setting
-            # We iterate through the stories and then the tag so that
-            # feed order is preserved.
-
-            for e in curfeed["entries"]:
-                for tag in self.cfg.never_discard:
-                    if tag == "unread":
-                        if "read" in e["canto_state"]:
-                            continue
-                    elif tag not in e["canto_state"]:
-                        continue
-                    if e not in newfeed["entries"]:
-                        newfeed["entries"].append(e)
+            newfeed["entries"], new = self.merge_entries(fetched, curfeed)
 
             if self.cfg.new_hook:
-                for entry in [e for e in new if e in newfeed["entries"]]:
-                    self.cfg.new_hook(newfeed, entry, entry == new[-1])
+                for i, entry in enumerate(new):
+                    self.cfg.new_hook(newfeed, entry, i == len(new) - 1)
 
-            # Dump the output to the new file.
+            # Dump the output to the store. Only entries that actually changed
+            # are rewritten.
 
-            # Locking and writing is counter-intuitive using fcntl. If you open
-            # with "w" and fail to get the lock, the data is still deleted. The
-            # solution is to open with "a", get the lock and then truncate the
-            # file.
-
-            f = open(self.fpath, "a")
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.store.create()
+            self.store.lock(fcntl.LOCK_EX)
 
             # The feed was modified out from under us.
-            if self.prevtime and self.prevtime != os.stat(self.fpath).st_mtime:
+            if self.prevtime and self.prevtime != self.store.stamp():
                 # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+                self.store.unlock()
 
                 # Reread the state from disk.
                 newer_curfeed = self.get_curfeed()
 
                 # There was an actual c-f update done, bail.
                 if newer_curfeed["canto_update"] != curfeed["canto_update"]:
+                    self.last_update = newer_curfeed["canto_update"]
                     self.log_func("%s updated already, bailing" %
                             self.fd.tags[0])
                     break
@@ -512,21 +1065,21 @@ class FetchThread(Thread):
                     curfeed = newer_curfeed
                     continue
 
-            # Truncate the file
-            f.seek(0, 0)
-            f.truncate()
-
             try:
-                # Dump the feed item. It's important to flush afterwards to
-                # avoid unlocking the file before all the IO is finished.
-                cPickle.dump(newfeed, f)
-                f.flush()
+                if not self.store.save(newfeed):
+                    self.log_func("%s entries unchanged" % self.fd.URL)
+                self.last_update = newfeed["canto_update"]
+
+                # Everything is new on the first fetch, which says nothing
+                # about how often the feed updates.
+
+                if curfeed["canto_update"]:
+                    self.new_count = len(new)
             except:
-                self.log_func("cPickle dump exception on %s" % self.fpath)
+                self.log_func("Store save exception on %s" % self.fpath)
             finally:
                 # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+                self.store.unlock()
 
             # If we managed to write to disk, break out of the while loop and
             # the thread will exit.
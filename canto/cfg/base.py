@@ -23,9 +23,10 @@ import triggers
 import gui
 import sorts
 import sources
+import fetch
 
 handlers = [tags, feeds, keys, style,\
-        links, hooks, filters, triggers, gui, sorts, sources]
+        links, hooks, filters, triggers, gui, sorts, sources, fetch]
 
 import xml.parsers.expat
 import traceback
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as 
+#   published by the Free Software Foundation.
+
+# Settings that only matter to canto-fetch. Canto-fetch doesn't call
+# validate(), so these are checked in post_parse instead.
+
+def register(c):
+    c.fetch_threads = 10
+    c.fetch_host_limit = 2
+
+    # Processes to parse feeds in. False (or 0) parses in the fetch threads,
+    # True uses one per CPU.
+
+    c.fetch_processes = False
+
+    # Stop parsing a feed after this many entries in a row that are already
+    # on disk (0 never stops), or after the feed's keep entries.
+
+    c.stop_after_known = 0
+    c.stop_after_keep = False
+
+    # Leave sanitizing entry content to the client, when it's read.
+
+    c.defer_sanitize = False
+
+    # Adaptive rates are in minutes, like a feed's rate.
+
+    c.adaptive_rate = False
+    c.adaptive_rate_min = 1
+    c.adaptive_rate_max = 1440
+
+    c.locals.update({
+        "fetch_threads" : c.fetch_threads,
+        "fetch_host_limit" : c.fetch_host_limit,
+        "fetch_processes" : c.fetch_processes,
+        "stop_after_known" : c.stop_after_known,
+        "stop_after_keep" : c.stop_after_keep,
+        "defer_sanitize" : c.defer_sanitize,
+        "adaptive_rate" : c.adaptive_rate,
+        "adaptive_rate_min" : c.adaptive_rate_min,
+        "adaptive_rate_max" : c.adaptive_rate_max})
+
+def post_parse(c):
+    for attr in ["fetch_threads", "fetch_host_limit", "fetch_processes",
+            "stop_after_known", "stop_after_keep", "defer_sanitize",
+            "adaptive_rate", "adaptive_rate_min", "adaptive_rate_max"]:
+        setattr(c, attr, c.locals[attr])
+
+    if type(c.fetch_threads) != int or c.fetch_threads < 1:
+        raise Exception, "fetch_threads must be an integer >= 1."
+
+    if type(c.fetch_host_limit) != int or c.fetch_host_limit < 0:
+        raise Exception, "fetch_host_limit must be an integer >= 0."
+
+    if type(c.fetch_processes) not in [bool, int] or c.fetch_processes < 0:
+        raise Exception, "fetch_processes must be True, False or an integer."
+
+    if type(c.stop_after_known) != int or c.stop_after_known < 0:
+        raise Exception, "stop_after_known must be an integer >= 0."
+
+    for attr in ["adaptive_rate_min", "adaptive_rate_max"]:
+        if type(getattr(c, attr)) != int or getattr(c, attr) < 1:
+            raise Exception, "%s must be an integer >= 1." % attr
+
+    if c.adaptive_rate_min > c.adaptive_rate_max:
+        raise Exception, "adaptive_rate_min must be <= adaptive_rate_max."
+
+def validate(c):
+    pass
+
+def test(c):
+    pass
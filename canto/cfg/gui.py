@@ -24,6 +24,8 @@ def register(c):
     c.cursor_scroll = "scroll"
     c.cursor_edge = 5
 
+    c.max_fps = 20
+
     c.gui_top = 0
     c.gui_right = 0
     c.gui_height = 0
@@ -35,6 +37,7 @@ def register(c):
         "cursor_type" : c.cursor_type,
         "cursor_edge" : c.cursor_edge,
         "cursor_scroll" : c.cursor_scroll,
+        "max_fps" : c.max_fps,
         "status" : c.status,
         "reader_orientation" : c.reader_orientation,
         "reader_lines" : c.reader_lines,
@@ -43,7 +46,7 @@ def register(c):
 def post_parse(c):
     for attr in ["columns", "reader_orientation",
             "reader_lines", "status", "cursor_type", "cursor_scroll",
-            "cursor_edge"]:
+            "cursor_edge", "max_fps"]:
         setattr(c, attr, c.locals[attr])
 
 def validate(c):
@@ -66,6 +69,12 @@ def validate(c):
             raise Exception, """cursor_edge must be >= 0, not %d.""" %\
                     c.cursor_edge
 
+    if type(c.max_fps) not in [int, float]:
+        raise Exception, "max_fps must be a number > 0."
+
+    if c.max_fps <= 0:
+        raise Exception, "max_fps must be > 0, not %s" % c.max_fps
+
     if c.reader_orientation not in ["top","bottom","left","right",None]:
         raise Exception, """reader_orientation must be "top", "bottom",""" +\
             """ "left", "right", or None. Not "%s".""" % c.reader_orientation
@@ -16,7 +16,6 @@ import input
 
 import subprocess
 import locale
-import time
 import os
 import re
 
@@ -355,14 +354,12 @@ class by_date(Sort):
         return "By Date"
 
     def __call__(self, x, y):
-        # We wrap this, despite the fact that sorts are all
-        # wrapped in an exception logger because this is a
-        # normal, unimportant problem.
+        # Dates are stored as seconds since the epoch. Missing
+        # dates are a normal, unimportant problem.
 
-        try:
-            a = int(time.mktime(x["updated_parsed"]))
-            b = int(time.mktime(y["updated_parsed"]))
-        except:
+        a = x["updated_parsed"]
+        b = y["updated_parsed"]
+        if not a or not b:
             return 0
 
         return b - a
@@ -20,9 +20,9 @@
 # Canto shuts down.
 
 from const import STORY_QD, STORY_SAVED, STORY_UPDATED
+from store import FeedStore, find_key
 import story
 
-import cPickle
 import fcntl
 
 class Feed(list):
@@ -55,42 +55,84 @@ class Feed(list):
         self.filter = filter
 
         self.path = dirpath
+        self.store = FeedStore(dirpath)
         self.cfg = cfg
 
+        # Id -> position, and sid -> story, see reindex()
+        self.ids = {}
+        self.sids = {}
+
+        # Every story gets a serial id (sid) when it's first read in, which is
+        # how the interface and the worker process refer to it, see delta().
+        self.next_sid = 0
+
+        # The state of each story as the interface last saw it. The interface
+        # keeps this up to date too, so that a freshly forked worker starts out
+        # with it and doesn't resend every state on its first delta().
+        self.sent = {}
+
     def __eq__(self, other):
         return self.URL == other.URL
 
+    # The id index maps each story's id to its (first) position in the feed, so
+    # that finding a story doesn't mean scanning the whole list with
+    # Story.__eq__. Since stories are only ever added wholesale by extend() and
+    # apply_delta(), or removed with del feed[:], the index only has to be
+    # rebuilt in those places.
+
+    def reindex(self):
+        self.ids = {}
+        self.sids = {}
+        for i, item in enumerate(self):
+            if item["id"] not in self.ids:
+                self.ids[item["id"]] = i
+            self.sids[item.sid] = item
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.reindex()
+
+    # Find, __contains__ and index follow the semantics of Story.__eq__, an
+    # item matches if it has the same id and, if it has a feed, the same feed.
+
+    def find(self, item):
+        i = self.ids.get(item["id"], -1)
+        if i >= 0 and "feed" in item and item["feed"] != self.URL:
+            return -1
+        return i
+
+    def __contains__(self, item):
+        return self.find(item) >= 0
+
+    def index(self, item):
+        i = self.find(item)
+        if i < 0:
+            raise ValueError, "%s not in feed" % item["id"]
+        return i
+
+    # Only the stories' hot fields, and anything precached, are read from the
+    # store. Story() reads the rest of its entry on demand.
+
     def get_ufp(self):
         lockflags = fcntl.LOCK_SH
         if self.base_set:
             lockflags |= fcntl.LOCK_NB
 
         try:
-            f = open(self.path, "r")
-            try:
-                fcntl.flock(f.fileno(), lockflags)
-                ufp = cPickle.load(f)
-            except ImportError:
-                try:
-
-                    # Fortunately, I don't think forcing the cpickle
-                    # to use feedparser_builtin is harmful, since they're
-                    # basically the same class, feedparser_builtin is just the
-                    # only way to properly look up the toplevel module now.
-
-                    f.seek(0)
-                    data = f.read()
-                    data = data.replace("feedparser\n","feedparser_builtin\n",1)
-                    ufp = cPickle.loads(data)
-                except:
-                    return 0
-            except:
-                return 0
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+            self.store.upgrade()
+            self.store.lock(lockflags)
+        except:
+            return 0
+
+        try:
+            ufp = self.store.load(self.cfg.precache)
         except:
             return 0
+        finally:
+            self.store.unlock()
+
+        if not ufp:
+            return 0
         return ufp
 
     def update(self):
@@ -113,7 +155,8 @@ class Feed(list):
             self.tags = [ replace(x) for x in self.tags]
 
         self.extend(ufp["entries"])
-        self.todisk(ufp)
+        self.todisk(dict([(e["id"], e["canto_state"])\
+                for e in ufp["entries"]]))
         return 1
 
     # Extend's job is to take items from disk, strip them down to the items that
@@ -122,14 +165,19 @@ class Feed(list):
 
     def extend(self, entries):
         newlist = []
+        seen = {}
         for entry in entries:
 
-            # This checks existence in newlist as well to avoid
-            # duplicate items on feeds with duplicates in them.
+            # Skip duplicate items on feeds with duplicates in them.
             # (i.e. broken)
 
-            if entry in self and entry not in newlist:
-                centry = self[self.index(entry)]
+            if entry["id"] in seen:
+                continue
+            seen[entry["id"]] = 1
+
+            i = self.find(entry)
+            if i >= 0:
+                centry = self[i]
                 if (not centry.updated) and\
                     (centry["canto_state"] != entry["canto_state"]):
                     centry["canto_state"] = entry["canto_state"]
@@ -151,8 +199,9 @@ class Feed(list):
                 nentry["title_detail"] = entry["title_detail"]
 
             for pc in self.cfg.precache:
-                if pc in entry:
-                    nentry[pc] = entry[pc]
+                key = find_key(entry, pc)
+                if key:
+                    nentry[pc] = entry[key]
                 else:
                     nentry[pc] = None
 
@@ -175,50 +224,145 @@ class Feed(list):
                     nentry["canto_state"].append(tag)
                     updated = STORY_UPDATED
 
-            if nentry not in newlist:
-                newlist.append(story.Story(nentry, self.path, updated))
+            s = story.Story(nentry, self.path, updated)
+            s.sid = self.next_sid
+            self.next_sid += 1
+            newlist.append(s)
 
         del self[:]
         for item in newlist:
             if not self.filter or self.filter(self, item):
                 list.append(self, item)
+        self.reindex()
+
+    # The interface and the worker process each keep a copy of every feed (the
+    # worker's starts out as the interface's, since it's forked from it), and
+    # only send each other what's changed, rather than the whole feed each
+    # time. The interface sends the states it's changed with state_delta(),
+    # which the worker applies with apply_states() before updating. The worker
+    # replies with delta(), which the interface applies with apply_delta().
+
+    def state_delta(self):
+        states = [ (s.sid, s["canto_state"][:]) for s in self.changed() ]
+        for sid, state in states:
+            self.sent[sid] = state[:]
+        return states
+
+    def apply_states(self, states):
+        for sid, state in states:
+            s = self.sids.get(sid)
+            if not s:
+                continue
+            s["canto_state"] = state
+            s.updated = STORY_UPDATED
+            self.sent[sid] = state[:]
+
+    # A delta is (order, added, states). Order is the sids in the feed, or None
+    # if it's the same as prev, the list of stories the feed had before it was
+    # updated. Added is the stories that weren't in prev, and states is
+    # (sid, state) for every other story whose state isn't what the interface
+    # last saw.
+
+    def delta(self, prev):
+        prev_sids = dict([ (s.sid, 1) for s in prev ])
+        order = [ s.sid for s in self ]
+        if order == [ s.sid for s in prev ]:
+            order = None
+
+        added = []
+        states = []
+        for s in self:
+            if s.sid not in prev_sids:
+                added.append(s)
+            elif self.sent.get(s.sid) != s["canto_state"]:
+                states.append((s.sid, s["canto_state"][:]))
+
+        self.sent = dict([ (s.sid, s["canto_state"][:]) for s in self ])
+        return (order, added, states)
+
+    # Applying a delta means that the new items are unvalidated and
+    # unfiltered. States are only taken for stories that haven't been changed
+    # since they were last sent to the worker, and anything that has been sent
+    # is now the worker's to save. Either way, sent is updated to match the
+    # worker's, which is what the next worker will be forked with.
+
+    def apply_delta(self, delta):
+        order, added, states = delta
+
+        sids = self.sids
+        if added:
+            sids = dict(sids)
+            for s in added:
+                sids[s.sid] = s
+                self.next_sid = max(self.next_sid, s.sid + 1)
+
+        for s in added:
+            self.sent[s.sid] = s["canto_state"][:]
+
+        for sid, state in states:
+            s = sids[sid]
+            if s.updated in [STORY_SAVED, STORY_QD]:
+                s["canto_state"] = state
+            self.sent[sid] = state[:]
+
+        if order != None:
+            list.__delslice__(self, 0, len(self))
+            list.extend(self, [ sids[sid] for sid in order ])
+            self.reindex()
+            self.sent = dict([ (sid, self.sent[sid]) for sid in order\
+                    if sid in self.sent ])
+
+        for s in self:
+            if s.updated == STORY_QD:
+                s.updated = STORY_SAVED
+
+    # get_states is a much cheaper get_ufp, for when only the current state of
+    # each entry is needed, since the entries themselves are never read.
+
+    def get_states(self):
+        lockflags = fcntl.LOCK_SH
+        if self.base_set:
+            lockflags |= fcntl.LOCK_NB
 
-    # Merging items means that they're unvalidated and unfiltered. This is
-    # used when story objects are read in from a pipe.
+        try:
+            self.store.lock(lockflags)
+        except:
+            return 0
 
-    def merge(self, iter):
-        for i, item in enumerate(iter):
-            if item in self:
-                cur = self[self.index(item)]
-                if cur.updated in [STORY_SAVED, STORY_QD]:
-                    cur["canto_state"] = item["canto_state"]
-                    cur.updated = 0
-                iter[i] = cur
+        try:
+            states = self.store.load_states()
+        except:
+            return 0
+        finally:
+            self.store.unlock()
 
-        del self[:]
-        list.extend(self, iter)
+        if states == None:
+            return 0
+        return states
 
     # todisk is the complement to get_ufp, however, since the state may have
     # changed on any of the items, it has to intelligently merge the changes
-    # before writing to disk.
+    # before writing to disk. Only the changed states are written, as appends
+    # to the store's state journal.
 
-    def todisk(self, ufp=None):
-        if ufp == None:
-            ufp = self.get_ufp()
-        if not ufp:
+    def todisk(self, states=None):
+        if states == None:
+            states = self.get_states()
+        if states == 0:
             return
 
         changed = self.changed()
         if not changed :
             return
 
+        records = []
         for entry in changed:
             # We've stopped caring about this item
-            if entry not in ufp["entries"]:
+            if entry["id"] not in states:
                 continue
 
-            old = ufp["entries"][ufp["entries"].index(entry)]
-            if old["canto_state"] != entry["canto_state"]:
+            old = states[entry["id"]]
+            if old != entry["canto_state"]:
                 # States differ, and we've recorded an update, that means we
                 # probably have the newer information, so we handle the
                 # state_change_hook in a batch and overwrite the old data
@@ -226,11 +370,12 @@ class Feed(list):
                 if entry.updated:
                     if self.cfg.state_change_hook:
                         add = [t for t in entry["canto_state"] if\
-                               t not in old["canto_state"]]
-                        rem = [t for t in old["canto_state"] if\
+                               t not in old]
+                        rem = [t for t in old if\
                                t not in entry["canto_state"]]
                         self.cfg.state_change_hook(self, entry, add, rem)
-                    old["canto_state"] = entry["canto_state"]
+                    states[entry["id"]] = entry["canto_state"]
+                    records.append((entry["id"], entry["canto_state"]))
 
 
                 # States differ, but we have no change, most likely the on disk
@@ -239,24 +384,22 @@ class Feed(list):
                 # state_change_hook.
 
                 else:
-                    entry["canto_state"] = old["canto_state"]
+                    entry["canto_state"] = old
+
+        # Journal only the states that actually changed.
+        try:
+            self.store.lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except:
+            return 0
 
-        # Dump the feed to disk.
-        f = open(self.path, "r+")
         try:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            f.seek(0, 0)
-            f.truncate()
-            cPickle.dump(ufp, f)
-            f.flush()
+            self.store.append_states(records)
             for x in changed:
                 x.updated = STORY_SAVED
         except:
             return 0
         finally:
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            f.close()
-        del ufp
+            self.store.unlock()
         return 1
 
     def changed(self):
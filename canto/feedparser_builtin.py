@@ -353,6 +353,7 @@ class _FeedParserMixin:
     can_be_relative_uri = ['link', 'id', 'wfw_comment', 'wfw_commentrss', 'docs', 'url', 'href', 'comments', 'license', 'icon', 'logo']
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
+    can_be_deferred = ['content', 'summary', 'description']
     html_types = ['text/html', 'application/xhtml+xml']
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
@@ -365,6 +366,9 @@ class _FeedParserMixin:
         self.entries = [] # list of entry-level data
         self.version = '' # feed type/version, see SUPPORTED_VERSIONS
         self.namespacesInUse = {} # dictionary of namespaces defined by the feed
+        self.entry_hook = None # called with each entry as it's finished
+        self.date_memo = {} # field -> date handler that last worked for it
+        self.defer_html = 0 # leave entry content for sanitizeDeferred
 
         # the following are used internally to track state;
         # this is really out of control and should be refactored
@@ -636,14 +640,20 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
+        # with defer_html, entry content is left as is, and marked as deferred
+        # so that it can be cleaned up by sanitizeDeferred when it's needed
+        deferred = self.defer_html and self.inentry and self.incontent and \
+            (not self.insource) and (element in self.can_be_deferred) and \
+            self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types
+
         # resolve relative URIs within embedded markup
         if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_relative_uris:
+            if element in self.can_contain_relative_uris and not deferred:
                 output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
         
         # sanitize embedded markup
         if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_dangerous_markup:
+            if element in self.can_contain_dangerous_markup and not deferred:
                 output = _sanitizeHTML(output, self.encoding)
 
         if self.encoding and type(output) != type(u''):
@@ -662,6 +672,8 @@ class _FeedParserMixin:
                 self.entries[-1].setdefault(element, [])
                 contentparams = copy.deepcopy(self.contentparams)
                 contentparams['value'] = output
+                if deferred:
+                    contentparams['deferred'] = 1
                 self.entries[-1][element].append(contentparams)
             elif element == 'link':
                 self.entries[-1][element] = output
@@ -674,6 +686,8 @@ class _FeedParserMixin:
                 if self.incontent:
                     contentparams = copy.deepcopy(self.contentparams)
                     contentparams['value'] = output
+                    if deferred:
+                        contentparams['deferred'] = 1
                     self.entries[-1][element + '_detail'] = contentparams
         elif (self.infeed or self.insource) and (not self.intextinput) and (not self.inimage):
             context = self._getContext()
@@ -1028,6 +1042,8 @@ class _FeedParserMixin:
     def _end_item(self):
         self.pop('item')
         self.inentry = 0
+        if self.entry_hook and self.entries and self.entry_hook(self.entries[-1]):
+            raise _StopParsing()
     _end_entry = _end_item
 
     def _start_dc_language(self, attrsD):
@@ -1054,7 +1070,7 @@ class _FeedParserMixin:
 
     def _end_published(self):
         value = self.pop('published')
-        self._save('published_parsed', _parse_date(value))
+        self._save('published_parsed', _parse_date(value, self.date_memo, 'published'))
     _end_dcterms_issued = _end_published
     _end_issued = _end_published
 
@@ -1067,7 +1083,7 @@ class _FeedParserMixin:
 
     def _end_updated(self):
         value = self.pop('updated')
-        parsed_value = _parse_date(value)
+        parsed_value = _parse_date(value, self.date_memo, 'updated')
         self._save('updated_parsed', parsed_value)
     _end_modified = _end_updated
     _end_dcterms_modified = _end_updated
@@ -1080,14 +1096,14 @@ class _FeedParserMixin:
 
     def _end_created(self):
         value = self.pop('created')
-        self._save('created_parsed', _parse_date(value))
+        self._save('created_parsed', _parse_date(value, self.date_memo, 'created'))
     _end_dcterms_created = _end_created
 
     def _start_expirationdate(self, attrsD):
         self.push('expired', 1)
 
     def _end_expirationdate(self):
-        self._save('expired_parsed', _parse_date(self.pop('expired')))
+        self._save('expired_parsed', _parse_date(self.pop('expired'), self.date_memo, 'expired'))
 
     def _start_cc_license(self, attrsD):
         self.push('license', 1)
@@ -1657,6 +1673,15 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
         if not self.unacceptablestack:
             _BaseHTMLProcessor.handle_data(self, text)
 
+def sanitizeDeferred(htmlSource, baseURI, encoding='utf-8'):
+    '''Resolves relative URIs in and sanitizes content that was parsed with
+    defer_html, returning unicode'''
+    output = _resolveRelativeURIs(htmlSource, baseURI, encoding)
+    output = _sanitizeHTML(output, encoding)
+    if type(output) != type(u''):
+        output = unicode(output, encoding, 'replace')
+    return output
+
 def _sanitizeHTML(htmlSource, encoding):
     p = _HTMLSanitizer(encoding)
     p.feed(htmlSource)
@@ -2233,21 +2258,46 @@ _additional_timezones = {'AT': -400, 'ET': -500, 'CT': -600, 'MT': -700, 'PT': -
 rfc822._timezones.update(_additional_timezones)
 registerDateHandler(_parse_date_rfc822)    
 
-def _parse_date(dateString):
-    '''Parses a variety of date formats into a 9-tuple in GMT'''
-    for handler in _date_handlers:
+# Recently parsed date strings -> (9-tuple, handler). Entries in a feed often
+# share timestamps, and the same entries come back on every fetch.
+_date_cache = {}
+_DATE_CACHE_SIZE = 4096
+
+def _parse_date(dateString, memo=None, field=None):
+    '''Parses a variety of date formats into a 9-tuple in GMT
+
+    If memo is given, it's a dict of field -> the handler that last worked
+    for that field, which is tried first, and is updated.'''
+    cached = _date_cache.get(dateString)
+    if cached:
+        date9tuple, handler = cached
+    else:
+        handlers = _date_handlers
+        if memo and memo.get(field) in _date_handlers[1:]:
+            handlers = [memo[field]] + [h for h in _date_handlers if h != memo[field]]
+        date9tuple, handler = None, None
+        for h in handlers:
+            try:
+                parsed = h(dateString)
+                if not parsed: continue
+                if len(parsed) != 9:
+                    if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
+                    raise ValueError
+                map(int, parsed)
+                date9tuple, handler = parsed, h
+                break
+            except Exception, e:
+                if _debug: sys.stderr.write('%s raised %s\n' % (h.__name__, repr(e)))
+                pass
+        if len(_date_cache) >= _DATE_CACHE_SIZE:
+            _date_cache.clear()
         try:
-            date9tuple = handler(dateString)
-            if not date9tuple: continue
-            if len(date9tuple) != 9:
-                if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
-                raise ValueError
-            map(int, date9tuple)
-            return date9tuple
-        except Exception, e:
-            if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
+            _date_cache[dateString] = (date9tuple, handler)
+        except TypeError:
             pass
-    return None
+    if memo is not None and handler:
+        memo[field] = handler
+    return date9tuple
 
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
@@ -2456,8 +2506,34 @@ def _stripDoctype(data):
     data = doctype_pattern.sub('', data)
     return version, data
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+class _StopParsing(Exception): pass
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], entry_hook=None, hints=None, defer_html=0):
+    '''Parse a feed from a URL, file, stream, or string
+
+    If entry_hook is given, it's called with each entry as soon as it has been
+    parsed. If it returns true, parsing stops there, and result['stopped'] is
+    set.
+
+    hints is a dict of what worked the last time this feed was parsed:
+    'encoding' is tried before falling back on chardet, and a 'parser' of
+    'loose' skips the strict parser. result['parser'] is the parser that was
+    used, and result['hints'] says, for each hint that mattered, whether it
+    was a 'hit' or a 'miss' (full detection, or a strict parser failure).
+    'dates' maps fields to the names of the date handlers that parsed them,
+    which are tried first, and result['date_handlers'] is the same for this
+    parse.
+
+    With defer_html, HTML entry content and summaries aren't sanitized and
+    don't have their relative URIs resolved. Instead their details are marked
+    'deferred', and sanitizeDeferred can be run on them later.'''
+    hints = hints or {}
+    hinted = {}
+    date_memo = {}
+    for field, name in (hints.get('dates') or {}).items():
+        for handler in _date_handlers:
+            if handler.__name__ == name:
+                date_memo[field] = handler
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -2560,6 +2636,19 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             break
         except:
             pass
+    # if no luck, try the encoding that worked last time, before detection
+    hinted_encoding = hints.get('encoding')
+    if (not known_encoding) and hinted_encoding and (hinted_encoding not in tried_encodings):
+        tried_encodings.append(hinted_encoding)
+        try:
+            data = _toUTF8(data, hinted_encoding)
+            proposed_encoding = hinted_encoding
+            known_encoding = use_strict_parser = 1
+            hinted['encoding'] = 'hit'
+        except:
+            pass
+    if not known_encoding:
+        hinted['encoding'] = 'miss'
     # if no luck and we have auto-detection library, try that
     if (not known_encoding) and chardet:
         try:
@@ -2605,9 +2694,16 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
 
     if not _XML_AVAILABLE:
         use_strict_parser = 0
+    # skip the strict parser if it failed last time
+    if use_strict_parser and hints.get('parser') == 'loose':
+        use_strict_parser = 0
+        hinted['parser'] = 'hit'
     if use_strict_parser:
         # initialize the SAX parser
         feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser.entry_hook = entry_hook
+        feedparser.date_memo = date_memo
+        feedparser.defer_html = defer_html
         saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
@@ -2620,6 +2716,8 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
         try:
             saxparser.parse(source)
+        except _StopParsing:
+            result['stopped'] = 1
         except Exception, e:
             if _debug:
                 import traceback
@@ -2629,11 +2727,21 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             result['bozo'] = 1
             result['bozo_exception'] = feedparser.exc or e
             use_strict_parser = 0
+            hinted['parser'] = 'miss'
+    result['parser'] = use_strict_parser and 'strict' or 'loose'
+    result['hints'] = hinted
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '')
-        feedparser.feed(data)
+        feedparser.entry_hook = entry_hook
+        feedparser.date_memo = date_memo
+        feedparser.defer_html = defer_html
+        try:
+            feedparser.feed(data)
+        except _StopParsing:
+            result['stopped'] = 1
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
+    result['date_handlers'] = dict([(field, handler.__name__) for field, handler in date_memo.items()])
     result['version'] = result['version'] or feedparser.version
     result['namespaces'] = feedparser.namespacesInUse
     return result
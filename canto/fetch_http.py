@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# HTTP plumbing for canto-fetch. canto-fetch builds its own urllib2 openers
+# (for the auth handlers), which means it bypasses all of the niceties that
+# feedparser's _open_resource adds to a request, so they're reimplemented here
+# as urllib2 handlers that can be added to any opener.
+
+# CompressionHandler asks for gzip/deflate transfer encoding on every request,
+# and wraps every response in a CountingReader that decompresses the body as
+# it's read and keeps track of the bytes that actually came over the wire.
+
+# KeepAliveHandler replaces urllib2's HTTP(S) handlers, which close the
+# connection after every request, with ones that take connections from a
+# ConnectionPool and give them back once the response has been read, so
+# feeds on the same host don't pay for a new TCP (and TLS) handshake each.
+
+# BasicAuthHandler and DigestAuthHandler are urllib2's, except that the 401
+# is read and closed before the request is retried with credentials, so its
+# connection goes back into the pool for the retry to use.
+
+from StringIO import StringIO
+import threading
+import httplib
+import urllib2
+import urllib
+import select
+import socket
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+# The most idle connections kept around for any one host.
+
+MAX_IDLE = 4
+
+class CountingReader():
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.encoding = encoding
+        self.wire_bytes = 0
+        self.bytes = 0
+        self.buf = ""
+        self.eof = False
+
+        if encoding == "gzip":
+            self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decomp = zlib.decompressobj()
+        else:
+            self.decomp = None
+
+    def _decompress(self, data):
+        if not self.decomp:
+            return data
+        try:
+            return self.decomp.decompress(data)
+        except zlib.error:
+            # Plenty of servers send raw deflate data instead of the zlib
+            # stream that "deflate" is supposed to mean. That can only be
+            # detected on the first chunk, so start over without a header.
+
+            if self.encoding != "deflate" or self.wire_bytes != len(data):
+                raise
+            self.decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decomp.decompress(data)
+
+    # Fill reads from the underlying response until there are at least size
+    # decompressed bytes buffered (or everything if size is None).
+
+    def _fill(self, size):
+        while not self.eof and (size == None or len(self.buf) < size):
+            data = self.fp.read(CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                if self.decomp:
+                    self.buf += self.decomp.flush()
+                break
+            self.wire_bytes += len(data)
+            self.buf += self._decompress(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = None
+        self._fill(size)
+        if size == None:
+            r, self.buf = self.buf, ""
+        else:
+            r, self.buf = self.buf[:size], self.buf[size:]
+        self.bytes += len(r)
+        return r
+
+    def readline(self):
+        while "\n" not in self.buf and not self.eof:
+            self._fill(len(self.buf) + 1)
+        if "\n" in self.buf:
+            idx = self.buf.index("\n") + 1
+        else:
+            idx = len(self.buf)
+        r, self.buf = self.buf[:idx], self.buf[idx:]
+        self.bytes += len(r)
+        return r
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+class CompressionHandler(urllib2.BaseHandler):
+    def http_request(self, request):
+        request.add_unredirected_header("Accept-encoding", "gzip, deflate")
+        return request
+
+    def http_response(self, request, response):
+        encoding = response.info().get("content-encoding", "").lower()
+        reader = CountingReader(response, encoding)
+
+        # The body is decompressed by the time anyone reads it, so the header
+        # has to go or feedparser will try to decompress it again.
+
+        headers = response.info()
+        if "content-encoding" in headers:
+            del headers["content-encoding"]
+
+        wrapped = urllib.addinfourl(reader, headers, response.geturl(),
+                getattr(response, "code", None))
+        wrapped.msg = getattr(response, "msg", None)
+        wrapped.reader = reader
+        return wrapped
+
+    https_request = http_request
+    https_response = http_response
+
+# Returns (wire bytes, decompressed bytes) for a response opened through a
+# CompressionHandler, or None.
+
+def transfer_stats(response):
+    reader = getattr(response, "reader", None)
+    if not reader:
+        return None
+    return (reader.wire_bytes, reader.bytes)
+
+# Reads the whole body of a response, returning it along with a response that
+# reads it back from memory, but otherwise looks the same (for feedparser).
+
+def buffered(response):
+    data = response.read()
+    response.close()
+
+    wrapped = urllib.addinfourl(StringIO(data), response.info(),
+            response.geturl(), getattr(response, "code", None))
+    wrapped.msg = getattr(response, "msg", None)
+    wrapped.reader = getattr(response, "reader", None)
+    return (data, wrapped)
+
+# Discard reads whatever is left of a response (or an HTTPError, which is
+# one) and closes it.
+
+def discard(response):
+    try:
+        response.read()
+        response.close()
+    except:
+        pass
+
+class BasicAuthHandler(urllib2.HTTPBasicAuthHandler):
+    def http_error_401(self, req, fp, code, msg, headers):
+        discard(fp)
+        return urllib2.HTTPBasicAuthHandler.http_error_401(self, req, fp,
+                code, msg, headers)
+
+class DigestAuthHandler(urllib2.HTTPDigestAuthHandler):
+    def http_error_401(self, req, fp, code, msg, headers):
+        discard(fp)
+        return urllib2.HTTPDigestAuthHandler.http_error_401(self, req, fp,
+                code, msg, headers)
+
+# Freeze and thaw turn a buffered response into something that can be pickled
+# and back again, so that it can be parsed in another process. Scripts' output
+# is just a string, and is passed through.
+
+def freeze(source):
+    if type(source) in [str, unicode]:
+        return None
+    return (source.geturl(), getattr(source, "code", None),
+            getattr(source, "msg", None), str(source.info()))
+
+def thaw(data, frozen):
+    if not frozen:
+        return data
+
+    url, code, msg, headers = frozen
+    wrapped = urllib.addinfourl(StringIO(data),
+            httplib.HTTPMessage(StringIO(headers)), url, code)
+    wrapped.msg = msg
+    return wrapped
+
+# The ConnectionPool holds idle connections keyed by (scheme, host:port,
+# tunnel host). Connections are only ever used by one request at a time,
+# they're removed from the pool while in use.
+
+class ConnectionPool():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    # A connection that's readable while idle has either been closed by the
+    # server or has garbage on it, either way it's no good.
+
+    def alive(self, conn):
+        if not conn.sock:
+            return False
+        try:
+            r, w, x = select.select([conn.sock], [], [], 0)
+        except:
+            return False
+        return not r
+
+    # Get returns (connection, reused). If fresh is False, an idle connection
+    # is preferred, otherwise a new one is made with connect().
+
+    def get(self, key, connect, fresh=False):
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key, [])
+            while conns and not fresh:
+                conn = conns.pop()
+                if self.alive(conn):
+                    self.reused += 1
+                    return (conn, True)
+                conn.close()
+            self.opened += 1
+        finally:
+            self.lock.release()
+        return (connect(), False)
+
+    def put(self, key, conn):
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < MAX_IDLE:
+                conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    # Returns (connections opened, connections reused) since the pool was
+    # created.
+
+    def stats(self):
+        return (self.opened, self.reused)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+# PooledResponse is what urllib2 reads from. As soon as the body has been read
+# to the end the connection goes back into the pool. If it's closed early, or
+# the server wants to close it anyway, the connection is closed instead.
+
+class PooledResponse():
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def read(self, amt=None):
+        if amt == None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    recv = read
+
+    def release(self):
+        if not self.conn:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def close(self):
+        self.release()
+        self.response.close()
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, request):
+        return self.do_open(httplib.HTTPConnection, request)
+
+    def https_open(self, request):
+        kwargs = {}
+        if getattr(self, "_context", None):
+            kwargs["context"] = self._context
+        return self.do_open(httplib.HTTPSConnection, request, **kwargs)
+
+    # This follows urllib2's AbstractHTTPHandler.do_open, minus the
+    # "Connection: close" header.
+
+    def do_open(self, http_class, request, **kwargs):
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict([(k, v) for (k, v) in request.headers.items()\
+                if k not in headers]))
+        headers = dict([(k.title(), v) for (k, v) in headers.items()])
+
+        tunnel_headers = {}
+        if request._tunnel_host and "Proxy-Authorization" in headers:
+            tunnel_headers["Proxy-Authorization"] =\
+                    headers["Proxy-Authorization"]
+            del headers["Proxy-Authorization"]
+
+        def connect():
+            conn = http_class(host, timeout=request.timeout, **kwargs)
+            conn.set_debuglevel(self._debuglevel)
+            if request._tunnel_host:
+                conn.set_tunnel(request._tunnel_host, headers=tunnel_headers)
+            return conn
+
+        key = (request.get_type(), host, request._tunnel_host)
+
+        # A reused connection can still have been closed by the server
+        # between the liveness check and the request, so if it fails, try
+        # once more on a new connection.
+
+        for fresh in [False, True]:
+            conn, reused = self.pool.get(key, connect, fresh)
+            try:
+                conn.request(request.get_method(), request.get_selector(),
+                        request.data, headers)
+                response = conn.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+
+        body = PooledResponse(self.pool, key, conn, response)
+
+        # Bodiless responses (304, HEAD) are done already, and nobody is
+        # going to read them.
+
+        if response.length == 0 or request.get_method() == "HEAD":
+            body.read()
+
+        fp = socket._fileobject(body, close=True)
+        wrapped = urllib.addinfourl(fp, response.msg, request.get_full_url())
+        wrapped.code = response.status
+        wrapped.msg = response.reason
+        return wrapped
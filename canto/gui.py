@@ -35,8 +35,8 @@
 # draw_elements()   -> actually draw to the screen
 # key()             -> converts a single key to a group of actions
 # action()          -> perform a list of actions
-# alarm()           -> takes the diffs generated by the worker thread and
-#                       integrates it into the current tags
+# alarm()           -> takes a batch of diffs generated by the worker thread
+#                       and integrates them into the current tags
 
 # Most of these significant functions relay their events to a Reader() object,
 # if necessary.
@@ -390,13 +390,23 @@ class Gui(BaseGui) :
         return self.__pin_check_scroll()
 
     @change_selected
-    def alarm(self, new=[], old=[]):
+    def alarm(self, diffs=[]):
 
         # This is where the item diffs generated by the worker thread are
-        # integrated into the currently displayed tags. 
-
-        for lst in [new, old]:
-            if lst:
+        # integrated into the currently displayed tags. Diffs is a list of
+        # (new, old) pairs, one for each result from the worker, in the order
+        # they arrived.
+
+        # The whole batch is added up first, so that each tag is only extended
+        # and retracted once. A story is only in more than one diff if its feed
+        # was updated more than once, and then its adds and removes alternate,
+        # so they cancel out, leaving at most one of either.
+
+        changes = [ ({}, []) for t in self.tags ]
+        for new, old in diffs:
+            for lst, sign in [(new, 1), (old, -1)]:
+                if not lst:
+                    continue
                 for i, t in enumerate(lst):
                     if not t:
                         continue
@@ -414,11 +424,33 @@ class Gui(BaseGui) :
                     if l and self.tags[i].sorts.cur() == s and\
                         self.tags[i].filters.cur() == tf and\
                         self.cfg.filters.cur() == gf:
-                        # Add or remove them as necessary
-                        if lst is old:
-                            self.tags[i].retract(l)
-                        else:
-                            self.tags[i].extend(l)
+                        counts, order = changes[i]
+                        for x in l:
+                            # New items come with their index in the feed.
+                            if sign > 0:
+                                item = x[0]
+                            else:
+                                item = x
+                            if id(item) in counts:
+                                counts[id(item)][0] += sign
+                                counts[id(item)][1] = x
+                            else:
+                                counts[id(item)] = [sign, x]
+                                order.append(id(item))
+
+        # Add or remove them as necessary
+        for i, (counts, order) in enumerate(changes):
+            old = [ counts[k][1] for k in order if counts[k][0] < 0 ]
+            new = [ counts[k][1] for k in order if counts[k][0] > 0 ]
+            if old:
+                self.tags[i].retract(old)
+            if new:
+                # Each diff was sorted on its own, but sort_add needs them
+                # sorted all together.
+                sort = self.tags[i].sorts.cur()
+                if sort and len(diffs) > 1:
+                    new.sort(lambda a, b: sort(a[0], b[0]))
+                self.tags[i].extend(new)
 
         # Remap since we may have added or removed items
         # Keep the old map for closest item search.
@@ -9,7 +9,6 @@
 
 from curses import ascii
 import curses
-import signal
 import re
 
 # I am aware that Python's curses library comes with a TextBox class
@@ -96,9 +95,6 @@ def input(cfg, prompt):
 
     cfg.msg.move(0, len(prompt) + 2)
 
-    temp = signal.getsignal(signal.SIGALRM)
-    signal.signal(signal.SIGALRM, signal.SIG_IGN)
-
     # These curs_set calls can except, but we shouldn't care
     try:
         curses.curs_set(1)
@@ -112,9 +108,6 @@ def input(cfg, prompt):
     except:
         pass
 
-    signal.signal(signal.SIGALRM, temp)
-    signal.alarm(1)
-
     cfg.msg.erase()
     cfg.msg.refresh()
 
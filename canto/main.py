@@ -22,7 +22,7 @@
 #        check that Gui is still alive
 #        if we're waiting for a process, sleep
 #        check for input
-#            if no input, check on threads
+#            if no input, wait for input, the worker or the next tick
 #                if work done, update screen
 #            if input, pass to Gui and interpret return
 #                if return implies update, queue up work for thread
@@ -40,6 +40,9 @@ import tag
 
 import traceback
 import signal
+import select
+import errno
+import fcntl
 import locale
 import curses
 import time
@@ -97,6 +100,9 @@ class Main():
             self.restarting = False
         self.restart = False
 
+        # See wait()
+        self.wakeup_fds = []
+
         # Default arguments.
         flags = 0 
         feed_ct = None
@@ -187,7 +193,7 @@ class Main():
         for f in self.cfg.feeds:
             self.ph.send((PROC_UPDATE, f.URL, []))
         for f in self.cfg.feeds:
-            f.merge(self.ph.recv()[1])
+            self.ph.apply_result(self.ph.recv())
 
         self.ph.send((PROC_GETTAGS, ))
         fixedtags = self.ph.recv()
@@ -261,9 +267,9 @@ class Main():
 
         # The reason we clear the feeds first is that only after validation do
         # we know what keys are going to have to be precached, and canto tries
-        # hard to conserve items (see feed.merge), so we need to replace all of
-        # them with corrected, fresh items from the process that knows about the
-        # precache
+        # hard to conserve items (see feed.apply_delta), so we need to replace
+        # all of them with corrected, fresh items from the process that knows
+        # about the precache
 
         for f in self.cfg.feeds:
             del f[:]
@@ -299,6 +305,11 @@ class Main():
         self.resize = 0
         self.alarmed = 0
         self.ticks = 60
+        self.next_tick = time.time() + 1
+
+        # Diffs from the worker that aren't on the screen yet, see frame().
+        self.diffs = []
+        self.next_frame = 0
 
         self.cfg.height, self.cfg.width = self.cfg.stdscr.getmaxyx()
 
@@ -316,12 +327,18 @@ class Main():
 
         self.cfg.log("GUI initialized.")
 
-        # Signal handling
+        # Signal handling. The handlers only set flags, so each signal also
+        # writes a byte to the wakeup pipe, to wake up wait().
+
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wakeup_fds[1])
+
         signal.signal(signal.SIGWINCH, self.winch)
-        signal.signal(signal.SIGALRM, self.alarm)
         signal.signal(signal.SIGINT, self.done)
         signal.signal(signal.SIGUSR1, self.sigusr)
-        signal.alarm(1)
 
         self.cfg.log("Signals set.")
         self.estring = None
@@ -354,9 +371,10 @@ class Main():
                 if self.cfg.wait_for_pid:
                     signal.pause()
 
-                # Tick when SIGALRM is received.
-                if self.alarmed:
+                # Tick once a second, or right away if alarmed.
+                if self.alarmed or time.time() >= self.next_tick:
                     self.alarmed = 0
+                    self.next_tick = time.time() + 1
                     self.tick()
 
                 # Deferred update from signal
@@ -376,43 +394,11 @@ class Main():
                     self.refresh()
                     continue
 
-                # No input, time to check on the worker.
+                # No input, so sleep until there is, or the worker has
+                # results, or it's time to tick.
 
                 if k == -1:
-
-                    # Make sure we don't pin the CPU, so if there's no input and
-                    # no waiting updates, sleep for awhile.
-                    if not self.ph.pid:
-                        time.sleep(0.01)
-                        continue
-
-                    r = self.ph.recv(True, 0.01)
-                    if r:
-                        feed = [ f for f in self.cfg.feeds if f.URL == r[1]][0]
-                        if r[0] == PROC_UPDATE:
-                            old = []
-                            for gf, tf, s, l in r[4]:
-                                if not l:
-                                    old.append((gf, tf, s, l))
-                                    continue
-                                for i, oldidx in enumerate(l):
-                                    l[i] = feed[oldidx]
-                                old.append((gf, tf, s, l))
-
-                            feed.merge(r[2])
-
-                            new = []
-                            for gf, tf, s, l in r[3]:
-                                if not l:
-                                    new.append((gf, tf, s, None))
-                                    continue
-                                for i, newidx in enumerate(l):
-                                    l[i] = (feed[newidx], newidx)
-                                new.append((gf, tf, s, l))
-
-                            self.gui.alarm(new, old)
-                            self.gui.draw_elements()
-                        feed.qd = False
+                    self.wait()
                     continue
 
                 # Handle Meta pairs
@@ -427,6 +413,10 @@ class Main():
                 else:
                     t = (k, 0)
 
+                # Keys act on what's on the screen, so make sure it's current.
+                if self.diffs:
+                    self.frame()
+
                 # Key resolves a keypress tuple into a list of actions
                 actions = self.gui.key(t)
 
@@ -471,7 +461,7 @@ class Main():
         # Unset signals.
         for s in [signal.SIGWINCH, signal.SIGCHLD, signal.SIGINT]:
             signal.signal(s, signal.SIG_DFL)
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        signal.set_wakeup_fd(-1)
 
         # Kill the message log
         self.cfg.msg = None
@@ -501,6 +491,10 @@ class Main():
 
         self.ph.kill_process()
 
+        for fd in self.wakeup_fds:
+            os.close(fd)
+        self.wakeup_fds = []
+
     # For the most part, it's smart to avoid doing anything but set a flag in an
     # signal handler. CHLD is an exception because the only case in which we do
     # anymore work than just acknowledging the process is dead is when
@@ -523,7 +517,6 @@ class Main():
 
                 if self.cfg.wait_for_pid == pid:
                     self.cfg.wait_for_pid = 0
-                    signal.signal(signal.SIGALRM, self.alarm)
                     signal.signal(signal.SIGWINCH, self.winch)
                     self.alarmed = 1
                     self.resize = 1
@@ -535,9 +528,6 @@ class Main():
     def winch(self, a=None, b=None):
         self.resize = 1
 
-    def alarm(self, a=None, b=None):
-        self.alarmed = 1
-
     def sigusr(self, a, b):
         self.sigusr = 1
 
@@ -558,7 +548,77 @@ class Main():
         if self.cfg.msg_tick == 0:
             self.cfg.message(self.cfg.status(self.cfg), 1)
 
-        signal.alarm(1)
+    # Wait blocks until there's input on the terminal, the worker has results,
+    # the next tick or frame is due, or a signal comes in, in which case the
+    # main loop goes around to check the flags the handler set. Then every
+    # result the worker has ready is handled, and if it's time for another
+    # frame, they're all put on the screen at once.
+
+    def wait(self):
+        wakeup = self.wakeup_fds[0]
+        fds = [sys.stdin.fileno(), wakeup]
+        if self.ph.pid:
+            fds.append(self.ph.fileno())
+
+        timeout = self.next_tick
+        if self.diffs:
+            timeout = min(timeout, self.next_frame)
+        timeout = max(0, timeout - time.time())
+        try:
+            r, w, x = select.select(fds, [], [], timeout)
+            if wakeup in r:
+                os.read(wakeup, 4096)
+        except (select.error, OSError), e:
+            if e.args[0] not in [errno.EINTR, errno.EAGAIN]:
+                raise
+
+        while self.ph.pid:
+            r = self.ph.recv(False, 0)
+            if not r:
+                break
+            self.result(r)
+
+        if self.diffs and time.time() >= self.next_frame:
+            self.frame()
+
+    # Frame puts all of the pending diffs into the tags, and redraws, at most
+    # max_fps times a second.
+
+    def frame(self):
+        self.gui.alarm(self.diffs)
+        self.diffs = []
+        self.gui.draw_elements()
+        self.next_frame = time.time() + 1.0 / self.cfg.max_fps
+
+    # Result takes a result from the worker and applies it to the feed. The
+    # diffs are kept for the next frame().
+
+    def result(self, r):
+        feed = [ f for f in self.cfg.feeds if f.URL == r[1]][0]
+        if r[0] == PROC_UPDATE:
+            old = []
+            for gf, tf, s, l in r[4]:
+                if not l:
+                    old.append((gf, tf, s, l))
+                    continue
+                for i, oldsid in enumerate(l):
+                    l[i] = feed.sids[oldsid]
+                old.append((gf, tf, s, l))
+
+            feed.apply_delta(r[2])
+
+            new = []
+            for gf, tf, s, l in r[3]:
+                if not l:
+                    new.append((gf, tf, s, None))
+                    continue
+                for i, newsid in enumerate(l):
+                    item = feed.sids[newsid]
+                    l[i] = (item, feed.find(item))
+                new.append((gf, tf, s, l))
+
+            self.diffs.append((new, old))
+        feed.qd = False
 
     # Update is where the work is queued up for the work thread.
     def update(self, refilter = 0, iter = None, action=PROC_BOTH):
@@ -603,7 +663,7 @@ class Main():
                 continue
 
             self.ph.send(
-                    (action, f.URL, f[:],\
+                    (action, f.URL, f.state_delta(),\
                     self.cfg.all_filters.index(self.cfg.filters.cur()),
                     [(t.tag,\
                       self.cfg.all_filters.index(t.filters.cur()),\
@@ -32,14 +32,14 @@
 #
 #       (action, arguments...)
 #
-# There are a number of actions: (PROC_UPDATE, URL, old items) performs on disk
+# There are a number of actions: (PROC_UPDATE, URL, states) performs on disk
 # update only, this is used early in init when we're trying to rectify tags from
 # ondisk content
 #
 #   (PROC_GETTAGS, ) requests that the process return the rectified tags (i.e.
 #       collisions resolved)
 #
-#   (PROC_FILTER / PROCESS_BOTH , URL, old items, global filter index,
+#   (PROC_FILTER / PROCESS_BOTH , URL, states, global filter index,
 #       [tag_info], refilter) performs the filtering/sorting (in addition to
 #       update for BOTH) this is the most common full update. PROC_FILTER is
 #       only used after PROC_UPDATE early on. [tag_info] is a list of one tuple
@@ -53,7 +53,7 @@
 #       output until it gets it back. This is used when the items in the pipe
 #       are no longer accurate (i.e. the filter/sort/tag settings have changed.
 #
-#   (PROC_SYNC, URL, old items) This syncs the state to disk. Typically the
+#   (PROC_SYNC, URL, states) This syncs the state to disk. Typically the
 #       state is saved on update, but on exiting the program, it needs to be
 #       explicitly synced to disk so that any state changes made between the
 #       last disk update are saved.
@@ -62,17 +62,23 @@
 #       with an added clause so it terminates after returning the same tuple.
 #       After that tuple if received back, it's guaranteed that the process was
 #       safely exited and it can be assumed that the pipes are no longer active.
+#
+# The worker keeps its own copy of every feed, which starts out the same as the
+# interface's since it's forked from it, so the items themselves are never sent
+# in full more than once. The states are the (sid, state) pairs of the stories
+# the interface has changed since it last sent them (see Feed.state_delta()).
 
 # Most of the return tuples are self-explanatory. The most common return from
 # PROC_BOTH looks like this:
 #
-#       (URL, stories, newdiff, olddiff)
+#       (PROC_UPDATE, URL, delta, newdiff, olddiff)
 #
-# Where both diffs are arrays that match up with all of the currently used tags.
-# For each tag, the diff contains
+# Where delta is the change to the feed, since the last one the interface got
+# (see Feed.delta()), and both diffs are arrays that match up with all of the
+# currently used tags. For each tag, the diff contains
 #
 #       (global filter index, tag filter index, tag sort index, new/old item
-#           indices)
+#           sids)
 #
 # This diff includes information to keep everything in sync. While the thread
 # works the filters and sorts can change so when the interface thread receives
@@ -87,7 +93,7 @@
 # sink explicitly through the pipes, it might seem odd to pass index numbers
 # back and forth. However, passing lambdas or functions through pipes is not
 # easily possible because they are unpickle-able. The solution is that after the
-# os.fork(), the all_filters and all_sorts list (in addition to the empty Feed
+# os.fork(), the all_filters and all_sorts list (in addition to the Feed
 # objects) are still resident in the new process' memory. So we pass indices
 # into those lists to workaround the inability to pass the functions themselves.
 
@@ -102,97 +108,226 @@
 
 from const import *
 
-from threading import Thread, Lock
-from cPickle import dumps, loads
+from threading import Thread, Condition
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from collections import deque
 import select
 import signal
+import struct
 import errno
-import time
 import sys
+import io
 import os
 
+# Each object sent through a Queue is framed as a 4 byte, big endian length,
+# followed by that many bytes of binary pickle. The length means that the
+# reader knows exactly how much it's waiting for, instead of having to scan
+# everything it's read so far for a delimiter (which binary pickles can
+# contain anyway).
+
+HEADER = struct.Struct("!I")
+
+# Reads are done straight into a buffer that's kept between reads, which grows
+# as needed to hold the largest message seen so far. READ_SIZE is how much room
+# is left for each read, at least.
+
+READ_SIZE = 64 * 1024
+
+# The worker's results can hold entire feeds (when they're first read), so it's
+# not allowed to get more than this many ahead of the interface process. It's
+# enough for the interface to handle a whole update's worth of results at once.
+# The interface never waits for the worker to read its requests, so those
+# aren't bounded, or the two could end up waiting on each other.
+
+MAX_RESULTS = 1024
+
+# Objects put() in a Queue are written to the pipe by a separate thread, so
+# that the writer never blocks on a full pipe. The thread sleeps on a Condition
+# until there's something to write, and close() waits on it until everything
+# has been written. If maxsize is given, put() waits until fewer than that
+# many objects are waiting to be written.
+
 class Queue():
-    def __init__(self):
+    def __init__(self, maxsize=0):
         self.recvpipe, self.sendpipe = os.pipe()
+        self.reader = io.FileIO(self.recvpipe, "r", closefd=False)
 
         self.poll = select.poll()
         self.poll.register(self.recvpipe, select.POLLIN)
 
-        self.objlist = []
-        self.objlock = Lock()
+        self.maxsize = maxsize
+        self.objlist = deque()
+        self.cond = Condition()
+
+        # Objects put, but not yet completely written.
+        self.pending = 0
 
         self.thread = None
         self.alive = True
-        self.frag = ""
+
+        # Unparsed data is buf[start:end].
+        self.buf = bytearray(READ_SIZE)
+        self.start = 0
+        self.end = 0
 
     def _try_parse(self):
-        if "\0" in self.frag:
-            idx = self.frag.index("\0")
-            s, self.frag = self.frag[:idx], self.frag[idx+1:]
-            return loads(s)
-        return None
+        avail = self.end - self.start
+        if avail < HEADER.size:
+            return None
+
+        length = HEADER.unpack_from(self.buf, self.start)[0]
+        if avail < HEADER.size + length:
+            return None
+
+        data = str(buffer(self.buf, self.start + HEADER.size, length))
+        self.start += HEADER.size + length
+        return loads(data)
+
+    # Make room for the rest of the current message (or just READ_SIZE if its
+    # length isn't known yet) after the unparsed data, and read into it. Data is
+    # only moved to the front of the buffer when it would otherwise run out of
+    # room.
+
+    def _read(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        need = READ_SIZE
+        if self.end - self.start >= HEADER.size:
+            need = max(need, HEADER.size + self.start - self.end +\
+                    HEADER.unpack_from(self.buf, self.start)[0])
+
+        if len(self.buf) - self.end < need:
+            avail = self.end - self.start
+            if self.start:
+                self.buf[:avail] = self.buf[self.start:self.end]
+                self.start, self.end = 0, avail
+            if len(self.buf) - self.end < need:
+                self.buf.extend(bytearray(need - (len(self.buf) - self.end)))
+
+        read = self.reader.readinto(memoryview(self.buf)[self.end:])
+        if not read:
+            raise Exception, "Queue pipe closed"
+        self.end += read
 
     def get(self, block=True, timeout=None):
 
         # Parse a message out of the remaining fragment.
         r = self._try_parse()
-        if r:
+        if r != None:
             return r
 
-        ready = self.poll.poll(timeout)
+        # Timeouts are in seconds, poll() wants milliseconds.
+        if not block:
+            wait = 0
+        elif timeout == None:
+            wait = None
+        else:
+            wait = int(timeout * 1000)
+
+        ready = self.poll.poll(wait)
         if not ready:
             raise Exception
 
         while True:
             try:
-                self.frag += os.read(self.recvpipe, 1024)
+                self._read()
                 r = self._try_parse()
-                if r:
+                if r != None:
                     return r
-            except OSError, e:
+            except (OSError, IOError), e:
                 if e.errno == errno.EINTR:
                     continue
                 raise
 
+            # Don't wait for the rest of a partial message, unless asked to
+            # block indefinitely, but keep reading if it's already there.
+
             if block and timeout == None:
                 continue
+            if self.poll.poll(0):
+                continue
             break
 
         raise Exception
 
+    def _write(self, data):
+        offset = 0
+        while offset < len(data):
+            try:
+                offset += os.write(self.sendpipe, buffer(data, offset))
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+
     def feed_pipe(self):
-        while self.alive:
-            if not len(self.objlist):
-                time.sleep(0.1)
-                continue
-            self.objlock.acquire()
-            obj = self.objlist[0]
-            self.objlist = self.objlist[1:]
-            self.objlock.release()
+        while True:
+            self.cond.acquire()
+            try:
+                while self.alive and not self.objlist:
+                    self.cond.wait()
+                if not self.objlist:
+                    return
+                obj = self.objlist.popleft()
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+            # If the pipe breaks, nothing else can be sent either.
+
+            failed = False
+            try:
+                s = dumps(obj, HIGHEST_PROTOCOL)
+                self._write(HEADER.pack(len(s)))
+                self._write(s)
+            except (OSError, IOError):
+                failed = True
 
-            s = dumps(obj) + "\0"
-            while s:
-                try:
-                    written = os.write(self.sendpipe, s)
-                    s = s[written:]
-                except OSError, e:
-                    if e.errno != errno.EINTR:
-                        raise
+            self.cond.acquire()
+            try:
+                self.pending -= 1
+                if failed:
+                    self.alive = False
+                    self.objlist.clear()
+                    self.pending = 0
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+            if failed:
+                return
 
     def put(self, obj):
         if not self.thread:
             self.thread = Thread(target = self.feed_pipe)
             self.thread.start()
-        self.objlock.acquire()
-        self.objlist.append(obj)
-        self.objlock.release()
+
+        self.cond.acquire()
+        try:
+            while self.alive and self.maxsize and\
+                    len(self.objlist) >= self.maxsize:
+                self.cond.wait()
+            if not self.alive:
+                return
+            self.objlist.append(obj)
+            self.pending += 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
     def close(self):
         if self.thread:
-            while len(self.objlist): pass
-            self.alive = False
+            self.cond.acquire()
+            try:
+                while self.pending:
+                    self.cond.wait()
+                self.alive = False
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
             self.thread.join()
 
+        self.reader.close()
         os.close(self.recvpipe)
         os.close(self.sendpipe)
 
@@ -204,7 +339,7 @@ class ProcessHandler():
 
     def start_process(self, cfg, persist=False):
         self.persist = persist
-        self.updated = Queue()
+        self.updated = Queue(MAX_RESULTS)
         self.update = Queue()
         self.pid = os.fork()
         if not self.pid:
@@ -289,7 +424,7 @@ class ProcessHandler():
                 continue
             if action == PROC_SYNC:
                 feed = [ f for f in feeds if f.URL == args[0] ][0]
-                feed.merge(args[1])
+                feed.apply_states(args[1])
                 while feed.changed():
                     feed.todisk()
                 send((PROC_SYNC,))
@@ -298,15 +433,16 @@ class ProcessHandler():
             # PROC_UPDATE, just load the data from disk.
             if action >= PROC_UPDATE:
                 feed = [ f for f in feeds if f.URL == args[0] ][0]
-                feed.merge(args[1])
+                feed.apply_states(args[1])
+                prev = feed[:]
                 if not feed.update():
                     send((PROC_DEQD, feed.URL))
                     continue
+                delta = feed.delta(prev)
 
             if action == PROC_UPDATE:
-                send((action, feed[:]))
+                send((action, feed.URL, delta))
             else:
-                prev = args[1]
                 filter = args[2]
                 taginfo = args[3]
                 refilter = args[4]
@@ -316,16 +452,18 @@ class ProcessHandler():
 
                 # Step 1: Global Filters
 
+                prev_sids = dict([ (item.sid, 1) for item in prev ])
                 gf = all_filters[filter]
                 new = []
                 for item in feed:
-                    if (item in prev) or (gf and (not gf(feed, item))):
+                    if (item.sid in prev_sids) or\
+                            (gf and (not gf(feed, item))):
                         continue
                     new.append(item)
 
                 old = []
                 for item in prev:
-                    if (item in feed) and ((not gf) or gf(feed, item)):
+                    if (item.sid in feed.sids) and ((not gf) or gf(feed, item)):
                         continue
                     old.append(item)
 
@@ -362,18 +500,12 @@ class ProcessHandler():
                     if odiff[i]:
                         odiff[i].sort(sort)
 
-                # Step 4: Convert items into indices
-                for newdiff in ndiff:
-                    if not newdiff:
-                        continue
-                    for i, item in enumerate(newdiff):
-                        newdiff[i] = feed.index(newdiff[i])
-
-                for olddiff in odiff:
-                    if not olddiff:
+                # Step 4: Convert items into sids
+                for diff in ndiff + odiff:
+                    if not diff:
                         continue
-                    for i, item in enumerate(olddiff):
-                        olddiff[i] = prev.index(olddiff[i])
+                    for i, item in enumerate(diff):
+                        diff[i] = item.sid
 
                 # Step 5: Add parity information
                 for i, (t, tf, ts) in enumerate(taginfo):
@@ -381,10 +513,12 @@ class ProcessHandler():
                     odiff[i] = (filter, tf, ts, odiff[i])
 
                 # Step 6: Queue up the results for the interface process.
-                send((PROC_UPDATE, feed.URL, feed[:], ndiff, odiff))
+                send((PROC_UPDATE, feed.URL, delta, ndiff, odiff))
+
+    # The descriptor that's readable when the worker has results.
 
-            if action > PROC_UPDATE:
-                del feed[:]
+    def fileno(self):
+        return self.updated.recvpipe
 
     def send(self, obj):
         if not self.pid:
@@ -417,12 +551,22 @@ class ProcessHandler():
         self.kill_process()
         return r
 
+    # apply_result applies the feed delta in a result, if it has one. Results
+    # that are otherwise discarded still have to be applied, or the interface's
+    # feeds would no longer match the worker's.
+
+    def apply_result(self, r):
+        if r and r[0] == PROC_UPDATE:
+            feed = [ f for f in self.cfg.feeds if f.URL == r[1] ][0]
+            feed.apply_delta(r[2])
+
     def send_and_wait(self, symbol):
         self.send((symbol, ))
         while True:
             got = self.recv_raw()
             if got == (symbol, ):
                 return
+            self.apply_result(got)
 
         # Send_and_wait ignores all items on the queue
         # so none of the feeds are still queued.
@@ -443,6 +587,6 @@ class ProcessHandler():
 
     def sync(self):
         for f in self.cfg.feeds:
-            self.send((PROC_SYNC, f.URL, f[:]))
+            self.send((PROC_SYNC, f.URL, f.state_delta()))
         for f in self.cfg.feeds:
-            self.recv_raw()
+            self.apply_result(self.recv_raw())
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The Schedule() is how the canto-fetch daemon knows when feeds are due
+# without opening them. It's a single small pickle in the feed directory
+# (.schedule) mapping each feed's URL to a dict of:
+#
+#   "update"    -> the feed's canto_update, as of the last time it was run.
+#   "tried"     -> the last time it was run at all.
+#
+# A feed is due rate minutes after its last update, but is never run more
+# often than once per interval, which also spaces out retries of feeds that
+# keep failing.
+#
+# With adaptive_rate set, the rate is learned from how often a feed actually
+# gets new items, and kept in the same dict:
+#
+#   "estimate"  -> moving average of the seconds between new items.
+#   "last_new"  -> the last time new items showed up.
+#   "rate"      -> half of the estimate, in minutes, within the bounds set by
+#                  adaptive_rate_min and adaptive_rate_max.
+
+from store import loads, dumps
+import heapq
+import os
+
+class Schedule():
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.feeds = {}
+
+        # (min, max) rate when adaptive, else None.
+        self.adapt = None
+
+    def configure(self, cfg):
+        if cfg.adaptive_rate:
+            self.adapt = (cfg.adaptive_rate_min, cfg.adaptive_rate_max)
+        else:
+            self.adapt = None
+
+    def load(self):
+        try:
+            f = open(self.path, "r")
+            try:
+                self.feeds = loads(f.read())
+            finally:
+                f.close()
+        except:
+            self.feeds = {}
+
+    def save(self):
+        f = open(self.path + ".tmp", "w")
+        try:
+            f.write(dumps(self.feeds))
+            f.flush()
+        finally:
+            f.close()
+        os.rename(self.path + ".tmp", self.path)
+
+    def rate(self, fd):
+        if self.adapt:
+            return self.feeds.get(fd.URL, {}).get("rate", fd.rate)
+        return fd.rate
+
+    def due(self, fd, force=False):
+        times = self.feeds.get(fd.URL, {})
+        tried = times.get("tried", 0) + self.interval
+        if force:
+            return tried
+        return max(times.get("update", 0) + self.rate(fd) * 60, tried)
+
+    # New is the number of new items the run found, or None if nothing was
+    # actually fetched (the feed wasn't due, or the fetch failed).
+
+    def ran(self, fd, update, tried, new=None):
+        times = self.feeds.setdefault(fd.URL, {})
+        times["update"] = update
+        times["tried"] = tried
+        if self.adapt and new != None:
+            self.learn(fd, times, new, tried)
+
+    # Each run with new items pulls the estimate towards the time per new
+    # item since the last ones. Runs without new items only push it up once
+    # the feed has been quiet for longer than the estimate.
+
+    def learn(self, fd, times, new, now):
+        if "last_new" not in times:
+            times["last_new"] = now
+            return
+
+        estimate = times.get("estimate", fd.rate * 120)
+        quiet = now - times["last_new"]
+        if new:
+            estimate = 0.7 * estimate + 0.3 * (quiet / new)
+            times["last_new"] = now
+        elif quiet > estimate:
+            estimate = 0.7 * estimate + 0.3 * quiet
+
+        lo, hi = self.adapt
+        times["estimate"] = estimate
+        times["rate"] = min(max(estimate / 120.0, lo), hi)
+
+    # Drop feeds that are no longer configured.
+
+    def prune(self, feeds):
+        urls = [ fd.URL for fd in feeds ]
+        for url in self.feeds.keys():
+            if url not in urls:
+                del self.feeds[url]
+
+    # Returns a heap of (due time, feed) for the given feeds.
+
+    def heap(self, feeds, force=False):
+        h = [ (self.due(fd, force), i, fd) for (i, fd) in enumerate(feeds) ]
+        heapq.heapify(h)
+        return h
+
+    # Pops every feed that's due at time now off of a heap.
+
+    def pop_due(self, h, now):
+        due = []
+        while h and h[0][0] <= now:
+            due.append(heapq.heappop(h)[2])
+        return due
@@ -0,0 +1,886 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The FeedStore() is the on-disk format shared by canto-fetch and the client.
+#
+# Up to 0.7.10, every feed was a single pickle of the whole feedparser result,
+# which meant that reading one story, or saving one state change, required
+# unpickling (and usually rewriting) the entire feed. Now each feed is a
+# directory, living at the same path the old pickle did, laid out like this:
+#
+#   lock        -> empty file, only used to flock() the store as a whole. Its
+#                  mtime is bumped on every write that changes the feed (see
+#                  stamp()).
+#   meta        -> pickled dict of everything in the feedparser result but
+#                  "entries" and the FETCH_KEYS. So, "feed", "canto_state",
+#                  "version", etc.
+#   fetched     -> pickled dict of the FETCH_KEYS, canto-fetch's own
+#                  bookkeeping ("canto_update", the validators for the next
+#                  request, the response headers, etc.). This is kept apart
+#                  from everything else so that a fetch that changes nothing
+#                  (a 304, or the same entries again) can record that it
+#                  happened without rewriting the feed or bumping its stamp.
+#                  read_meta() returns the two together.
+#   index       -> pickled dict, see below.
+#   version     -> STORE_VERSION as text, the same as the index's, so that
+#                  checking it doesn't mean reading the whole index.
+#   hot         -> pickled dict of id -> the entry's HOT_FIELDS, everything
+#                  the client needs to list an entry without reading it.
+#   entries/    -> one pickle per entry, named by the SHA1 of its id. The
+#                  entry's canto_state is *not* stored here. An entry with
+#                  enough content also has a NAME.text file, see below.
+#   state       -> append-only journal of (id, canto_state) pickles. A state
+#                  change by the client is just an append to this file.
+#
+# The index looks like this:
+#
+#   "version"   -> STORE_VERSION, so future format changes can be detected.
+#   "ids"       -> entry ids, in feed order.
+#   "digests"   -> id -> SHA1 of the pickled entry, so that canto-fetch only
+#                  rewrites entries that actually changed. These are only a
+#                  hint, a stale digest just costs an extra write.
+#   "states"    -> id -> canto_state, as of the last time the journal was
+#                  compacted. Records in the journal override these.
+#   "blobs"     -> id -> the digest of the entry's text, if it has one.
+#
+# The journal is compacted (folded into "states" and truncated) every time
+# canto-fetch saves the feed, or by the client when the journal grows past
+# COMPACT_SIZE bytes.
+#
+# Entries and meta are stored as plain dicts, lists and strings, with every
+# time.struct_time (e.g. "updated_parsed") turned into an integer number of
+# seconds since the epoch (UTC), see plain(). That makes them smaller and
+# quicker to unpickle than FeedParserDicts, and means they can be read
+# without feedparser at all. Plain dicts don't know feedparser's aliases
+# (like "description" for "summary"), or the keys it makes up from others
+# ("category" from "tags"), so readers should look keys up with find_key(),
+# which falls back to ALIASES and DERIVED.
+#
+# The bulky fields that are only needed to actually read an entry (COLD_FIELDS,
+# i.e. its content) are split up by freeze(). The big strings (the HTML
+# itself) are pickled together and zlib compressed into the entry's
+# "canto_text", and what's left (types, bases, etc.) goes into "canto_cold",
+# with each string replaced by its index into the text. They stay that way
+# through load() and save(), so canto-fetch never has to touch them for
+# entries it already has, and are only put back together (by find_key) when
+# one of them is asked for.
+#
+# The text is content-addressed, so that an article that's in several feeds
+# (a site's main feed and its category feeds, planets, etc.) is only stored
+# once. It's written to .blobs/ in the feed directory, named by its SHA1, and
+# each entry that has it gets a hard link to it as entries/NAME.text, which
+# means the link count of the blob is its reference count. A blob that's down
+# to one link is no longer used by any entry, and is removed (see release()
+# and prune_blobs()). Since they're all the same file, the page cache only
+# holds one copy of the text, too.
+#
+# Note that the FeedStore() doesn't lock anything implicitly. Callers are
+# expected to lock() around any access, just like they had to flock() the
+# pickle before.
+
+import calendar
+import cPickle
+import errno
+import hashlib
+import tempfile
+import shutil
+import fcntl
+import time
+import zlib
+import os
+
+# Version 1 stored canto_state inside of each entry, versions 1 and 2 kept
+# the meta information in the index, and versions 1 through 3 stored
+# feedparser's own classes. Those are still read, but are moved to their new
+# homes (and formats) the next time the feed is saved, or upgrade_schema() is
+# called. Version 4 didn't compress anything, versions 1 through 5 had no
+# hot file, and versions 5 and 6 compressed the cold fields whole, into the
+# entry itself.
+
+STORE_VERSION = 7
+
+# The subset of FeedParserDict's keymap that applies to entries.
+
+ALIASES = { "guid" : "id",
+        "date" : "updated",
+        "date_parsed" : "updated_parsed",
+        "description" : "summary",
+        "modified" : "updated",
+        "modified_parsed" : "updated_parsed",
+        "issued" : "published",
+        "issued_parsed" : "published_parsed",
+        "copyright" : "rights",
+        "copyright_detail" : "rights_detail",
+        "url" : "href" }
+
+# The keys FeedParserDict makes up from an entry's tags, and how.
+
+DERIVED = { "category" : lambda tags: tags[0].get("term"),
+        "categories" : lambda tags: [ (t.get("scheme"), t.get("term"))\
+                for t in tags ] }
+
+# The parts of the meta that only say when and how the feed was last fetched,
+# see read_fetched(). Along with canto-fetch's own, these are what feedparser
+# records about the response, which differ every time (the Date header, for
+# one) even when the feed itself hasn't changed.
+
+FETCH_KEYS = ["canto_update", "canto_etag", "canto_modified", "canto_digest",
+        "canto_hints", "headers", "status", "href", "etag", "modified",
+        "updated", "bozo", "bozo_exception"]
+
+# What the client keeps in memory for every story (see Feed.extend), plus the
+# date for by_date, the only builtin sort or filter that precaches anything.
+# Feed.extend falls back on an entry's "href" if it has no "link", so save()
+# keeps that as the hot "link" instead.
+
+HOT_FIELDS = ["id", "title", "title_detail", "link", "updated_parsed"]
+
+COLD_FIELDS = ["content", "summary", "summary_detail"]
+COLD_KEY = "canto_cold"
+TEXT_KEY = "canto_text"
+BLOB_KEY = "canto_blob"
+
+# Suffix of blobs that are still being written, and how long until one that's
+# never finished is pruned anyway.
+BLOB_TMP = ".tmp"
+BLOB_TMP_AGE = 3600
+
+# Entries with less cold text than this are left alone, since it wouldn't
+# compress well enough to pay for the extra lookup.
+
+COLD_SIZE = 512
+
+COMPACT_SIZE = 64 * 1024
+
+# Pickles written with the system feedparser reference the "feedparser" module,
+# which may not be importable. Fortunately, forcing them to use
+# feedparser_builtin isn't harmful, since they're basically the same class,
+# feedparser_builtin is just the only way to properly look up the toplevel
+# module now.
+
+def loads(data):
+    try:
+        return cPickle.loads(data)
+    except ImportError:
+        data = data.replace("feedparser\n","feedparser_builtin\n",1)
+        return cPickle.loads(data)
+
+def dumps(obj):
+    return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+SCALARS = [str, unicode, int, long, float, bool, type(None)]
+
+# Plain returns a copy of a feedparser result (or any part of it) made of
+# nothing but builtin types. Times are converted with calendar.timegm since
+# feedparser's are all in UTC.
+
+def plain(obj):
+    t = type(obj)
+    if t in SCALARS:
+        return obj
+    if isinstance(obj, time.struct_time):
+        return calendar.timegm(obj)
+    if t == list:
+        return [ plain(v) for v in obj ]
+    if t == tuple:
+        return tuple([ plain(v) for v in obj ])
+    if hasattr(obj, "items"):
+        return dict([ (k, plain(v)) for (k, v) in obj.items() ])
+    return obj
+
+# The cold strings are the summary and the values of the summary_detail and
+# content, these are what the cold fields look like.
+
+def cold_details(cold):
+    details = [ cold.get("summary_detail") ] + cold.get("content", [])
+    return [ d for d in details if type(d) == dict and "value" in d ]
+
+# Freeze splits a plain entry's cold fields in place.
+
+def freeze(entry):
+    if type(entry.get(COLD_KEY)) == str:
+        thaw(entry)
+
+    cold = dict([ (k, entry[k]) for k in COLD_FIELDS if k in entry ])
+    if not cold:
+        return entry
+
+    strings = [ d["value"] for d in cold_details(cold) ]
+    strings.append(cold.get("summary"))
+    strings = [ s for s in strings if type(s) in [str, unicode] ]
+    if sum([ len(s) for s in strings ]) < COLD_SIZE:
+        return entry
+
+    texts = []
+    for s in strings:
+        if s not in texts:
+            texts.append(s)
+
+    def ref(s):
+        if type(s) not in [str, unicode]:
+            return s
+        return texts.index(s)
+
+    if "summary" in cold:
+        cold["summary"] = ref(cold["summary"])
+    for detail in cold_details(cold):
+        detail["value"] = ref(detail["value"])
+
+    for k in cold:
+        del entry[k]
+    entry[COLD_KEY] = cold
+    entry[TEXT_KEY] = zlib.compress(dumps(texts))
+    return entry
+
+# Thaw is freeze's complement, also in place. If the text has gone missing
+# (the entry was removed since it was read), the strings are empty.
+
+def thaw(entry):
+    if COLD_KEY not in entry:
+        return entry
+
+    cold = entry[COLD_KEY]
+    del entry[COLD_KEY]
+
+    # Versions 5 and 6
+    if type(cold) == str:
+        entry.update(loads(zlib.decompress(cold)))
+        return entry
+
+    data = entry.get(TEXT_KEY)
+    if TEXT_KEY in entry:
+        del entry[TEXT_KEY]
+    if isinstance(data, Blob):
+        data = data.read()
+
+    texts = []
+    if data:
+        texts = loads(zlib.decompress(data))
+
+    def deref(v):
+        if type(v) != int:
+            return v
+        if v < len(texts):
+            return texts[v]
+        return u""
+
+    if "summary" in cold:
+        cold["summary"] = deref(cold["summary"])
+    for detail in cold_details(cold):
+        detail["value"] = deref(detail["value"])
+
+    entry.update(cold)
+    return entry
+
+# Find_key returns the key that a stored entry actually holds the given key's
+# value under, or None. Cold fields are decompressed only if they have to be,
+# and derived keys are worked out and added to the entry.
+
+def find_key(entry, key):
+    if key in entry:
+        return key
+
+    if COLD_KEY in entry and\
+            (key in COLD_FIELDS or ALIASES.get(key) in COLD_FIELDS):
+        thaw(entry)
+        if key in entry:
+            return key
+
+    if ALIASES.get(key) in entry:
+        return ALIASES[key]
+
+    if key in DERIVED and entry.get("tags"):
+        entry[key] = DERIVED[key](entry["tags"])
+        return key
+    return None
+
+def record_name(id):
+    if type(id) == unicode:
+        id = id.encode("UTF-8")
+    return hashlib.sha1(str(id)).hexdigest()
+
+# A Blob stands in for an entry's text until it's actually needed.
+
+class Blob():
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+
+    def read(self):
+        try:
+            f = open(self.path, "r")
+        except:
+            return None
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+def blob_dir(feed_dir):
+    return os.path.join(feed_dir, ".blobs") + "/"
+
+# Remove every blob that isn't linked to by any entry anymore, like those of
+# feeds that have been removed wholesale. Blobs that are still being written
+# (see write_blob()) are left alone, unless they're old enough that whoever
+# was writing them must have died.
+
+def prune_blobs(feed_dir):
+    path = blob_dir(feed_dir)
+    if not os.path.isdir(path):
+        return 0
+
+    pruned = 0
+    for name in os.listdir(path):
+        try:
+            st = os.stat(path + name)
+            if name.endswith(BLOB_TMP) and\
+                    time.time() - st.st_mtime < BLOB_TMP_AGE:
+                continue
+            if st.st_nlink == 1:
+                os.unlink(path + name)
+                pruned += 1
+        except OSError:
+            pass
+    return pruned
+
+class FeedStore():
+    def __init__(self, path):
+        self.path = path
+        self.entry_dir = path + "/entries/"
+        self.blob_dir = blob_dir(os.path.dirname(path))
+        self.lockf = None
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def lock(self, flags):
+        self.lockf = open(self.path + "/lock", "a")
+        try:
+            fcntl.flock(self.lockf.fileno(), flags)
+        except:
+            self.lockf.close()
+            self.lockf = None
+            raise
+
+    def unlock(self):
+        if self.lockf:
+            fcntl.flock(self.lockf.fileno(), fcntl.LOCK_UN)
+            self.lockf.close()
+            self.lockf = None
+
+    # The stamp serves the same purpose the mtime of the pickle did, it lets
+    # canto-fetch detect that the client modified the store out from under it.
+
+    def stamp(self):
+        try:
+            return os.stat(self.path + "/lock").st_mtime
+        except:
+            return 0
+
+    def touch(self):
+        os.utime(self.path + "/lock", None)
+
+    def create(self):
+        if not self.exists():
+            os.mkdir(self.path)
+        if not os.path.exists(self.entry_dir):
+            os.mkdir(self.entry_dir)
+        open(self.path + "/lock", "a").close()
+
+        # The blob directory is shared, so someone else could make it first.
+        try:
+            os.mkdir(self.blob_dir)
+        except OSError:
+            pass
+
+    # All writes go through a temporary file and a rename so that a crash can
+    # never leave a half written index or entry behind.
+
+    def _write(self, path, data):
+        f = open(path + ".tmp", "w")
+        try:
+            f.write(data)
+            f.flush()
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+    def _read(self, path):
+        f = open(path, "r")
+        try:
+            return loads(f.read())
+        finally:
+            f.close()
+
+    def read_index(self):
+        try:
+            return self._read(self.path + "/index")
+        except:
+            return None
+
+    def write_index(self, index):
+        self._write(self.path + "/index", dumps(index))
+
+    def read_version(self):
+        try:
+            f = open(self.path + "/version", "r")
+            try:
+                return int(f.read())
+            finally:
+                f.close()
+        except:
+            return None
+
+    def write_version(self):
+        self._write(self.path + "/version", "%d\n" % STORE_VERSION)
+
+    def read_hot(self):
+        try:
+            return self._read(self.path + "/hot")
+        except:
+            return None
+
+    def write_hot(self, hot):
+        self._write(self.path + "/hot", dumps(hot))
+
+    # Entries and meta from stores older than version 4 are converted as
+    # they're read, so that readers only ever see plain data.
+
+    def read_meta(self, index=None):
+        meta = None
+        try:
+            meta = self._read(self.path + "/meta")
+        except:
+            if not index:
+                index = self.read_index()
+            if index and "meta" in index:
+                meta = index["meta"]
+
+        if meta != None and type(meta.get("feed", {})) != dict:
+            meta = plain(meta)
+        if meta != None:
+            meta.update(self.read_fetched())
+        return meta
+
+    def write_meta(self, meta):
+        self._write(self.path + "/meta", dumps(meta))
+
+    # Stores older than the fetched file have the FETCH_KEYS in the meta, which
+    # read_meta() still returns if there's nothing newer.
+
+    def read_fetched(self):
+        try:
+            return self._read(self.path + "/fetched")
+        except:
+            return {}
+
+    def write_fetched(self, fetched):
+        self._write(self.path + "/fetched", dumps(fetched))
+
+    # The journal is read until the first record that can't be unpickled, which
+    # is either EOF or a torn write at the tail.
+
+    def read_journal(self):
+        try:
+            f = open(self.path + "/state", "r")
+        except:
+            return []
+
+        records = []
+        try:
+            while True:
+                try:
+                    records.append(cPickle.load(f))
+                except:
+                    break
+        finally:
+            f.close()
+        return records
+
+    def append_states(self, records):
+        if not records:
+            return
+
+        f = open(self.path + "/state", "a")
+        try:
+            f.write("".join([dumps(r) for r in records]))
+            f.flush()
+        finally:
+            f.close()
+
+        if os.path.getsize(self.path + "/state") > COMPACT_SIZE:
+            self.compact()
+
+    # Load_states is the cheap way to get every entry's current state, without
+    # touching the entries themselves.
+
+    def load_states(self, index=None):
+        if not index:
+            index = self.read_index()
+            if not index:
+                return None
+
+        states = dict(index.get("states", {}))
+        for id, state in self.read_journal():
+            states[id] = state
+        return states
+
+    def compact(self):
+        index = self.read_index()
+        if not index:
+            return
+        index["states"] = self.load_states(index)
+        self.write_index(index)
+        open(self.path + "/state", "w").close()
+        self.touch()
+
+    def text_path(self, id):
+        return self.entry_dir + record_name(id) + ".text"
+
+    def get_entry(self, id):
+        try:
+            entry = self._read(self.entry_dir + record_name(id))
+        except:
+            return None
+        if type(entry) != dict:
+            entry = plain(entry)
+        if BLOB_KEY in entry:
+            entry[TEXT_KEY] = Blob(self.text_path(id), entry[BLOB_KEY])
+            del entry[BLOB_KEY]
+        return entry
+
+    # Link_blob makes the entry's text link point at the blob with the given
+    # digest, writing the blob first if it doesn't exist. Another feed can
+    # release the blob between the two, in which case it's written again.
+
+    # On filesystems that can't hard link (FAT, some network mounts), the
+    # entry gets its own copy of the text instead, and the blob, which nothing
+    # can link to, is released again.
+
+    def link_blob(self, id, digest, text):
+        path = self.blob_dir + digest
+        link = self.text_path(id)
+
+        for retry in [False, True]:
+            if not os.path.exists(path):
+                if isinstance(text, Blob):
+                    text = text.read()
+                    if text == None:
+                        return
+                self.write_blob(path, text)
+
+            try:
+                if os.path.exists(link + ".tmp"):
+                    os.unlink(link + ".tmp")
+                os.link(path, link + ".tmp")
+                os.rename(link + ".tmp", link)
+                return
+            except OSError, e:
+                if e.errno not in [errno.ENOENT, errno.EEXIST]:
+                    break
+
+        if isinstance(text, Blob):
+            text = Blob(path, digest).read()
+            if text == None:
+                return
+        self._write(link, text)
+        self.release(digest)
+
+    # Unlike the rest of the store, blobs can be written by several threads at
+    # once, so each gets its own temporary file (see prune_blobs()).
+
+    def write_blob(self, path, data):
+        fd, tmp = tempfile.mkstemp(suffix=BLOB_TMP, dir=self.blob_dir)
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(data)
+            f.flush()
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    # Release removes a blob that's no longer linked to by any entry.
+
+    def release(self, digest):
+        try:
+            if os.stat(self.blob_dir + digest).st_nlink == 1:
+                os.unlink(self.blob_dir + digest)
+        except OSError:
+            pass
+
+    # Put_entry writes a single entry, returning whether anything was actually
+    # written. If an index is given, the entry is skipped when its digest
+    # hasn't changed, and the digest is updated (but the index isn't written).
+
+    # An entry's text is written as a blob, and only the blob's digest is kept
+    # in the entry itself. The index keeps track of each entry's blob so that
+    # it can be released once the entry no longer uses it.
+
+    def put_entry(self, entry, index=None):
+        id = entry["id"]
+        blob = None
+        if TEXT_KEY in entry:
+            if isinstance(entry[TEXT_KEY], Blob):
+                blob = entry[TEXT_KEY].digest
+            else:
+                blob = hashlib.sha1(entry[TEXT_KEY]).hexdigest()
+
+        # The record is built in sorted order, so that the same entry always
+        # pickles the same, however its dict was put together.
+
+        items = [ (k, v) for (k, v) in entry.items() if k != TEXT_KEY ]
+        if blob:
+            items.append((BLOB_KEY, blob))
+        items.sort()
+        record = dict(items)
+
+        data = dumps(record)
+        old = None
+        if index:
+            digest = hashlib.sha1(data).hexdigest()
+            if index["digests"].get(id) == digest:
+                return 0
+            index["digests"][id] = digest
+            old = index["blobs"].get(id)
+
+        if blob:
+            if blob != old or not os.path.exists(self.text_path(id)):
+                self.link_blob(id, blob, entry[TEXT_KEY])
+        elif old:
+            self.unlink_text(id)
+        self._write(self.entry_dir + record_name(id), data)
+
+        if index:
+            if blob:
+                index["blobs"][id] = blob
+            elif old:
+                del index["blobs"][id]
+        if old and old != blob:
+            self.release(old)
+        return 1
+
+    def unlink_text(self, id):
+        try:
+            os.unlink(self.text_path(id))
+        except:
+            pass
+
+    def del_entry(self, index, id):
+        try:
+            os.unlink(self.entry_dir + record_name(id))
+        except:
+            pass
+        self.unlink_text(id)
+        if id in index["digests"]:
+            del index["digests"][id]
+        if id in index["blobs"]:
+            self.release(index["blobs"][id])
+            del index["blobs"][id]
+
+    # Load reconstitutes the old whole-feed dict, for the consumers that really
+    # need every entry.
+
+    # If keys are given, the entries only have the HOT_FIELDS and the given
+    # keys, and the entries themselves are only read if any of those keys
+    # aren't hot (or the store doesn't have a hot file yet).
+
+    def load(self, keys=None):
+        index = self.read_index()
+        if not index:
+            return None
+
+        meta = self.read_meta(index)
+        if meta == None:
+            return None
+
+        states = self.load_states(index)
+
+        hot = None
+        cold = []
+        if keys != None:
+            hot = self.read_hot()
+            cold = [ k for k in keys if k not in HOT_FIELDS ]
+
+        ufp = dict(meta)
+        ufp["entries"] = []
+        for id in index["ids"]:
+            if hot and id in hot:
+                entry = hot[id]
+                if cold:
+                    full = self.get_entry(id) or {}
+                    for k in cold:
+                        key = find_key(full, k)
+                        if key:
+                            entry[k] = full[key]
+            else:
+                entry = self.get_entry(id)
+            if not entry:
+                continue
+            if id in states:
+                entry["canto_state"] = states[id]
+            ufp["entries"].append(entry)
+        return ufp
+
+    # Save is the complement to load. Only entries that differ from what's on
+    # disk are written, and entries that have dropped out of the feed are
+    # removed. Entries and meta are written as plain() copies, with the cold
+    # fields of entries compressed, and the given ufp isn't modified.
+
+    # States are written into the index, and the journal is compacted. Any
+    # journal records are applied on top of the given states, since they could
+    # have been appended by the client after the caller loaded the feed.
+
+    # If no entry was written or removed, the ids and states match the index,
+    # and the meta is the same, then only the fetched file is written, and the
+    # rest of the store, including its stamp, is left alone. Returns whether
+    # anything but the fetched file changed.
+
+    def save(self, ufp):
+        self.create()
+        index = self.read_index()
+        if not index:
+            index = { "digests" : {} }
+        index.setdefault("blobs", {})
+
+        changed = index.get("version") != STORE_VERSION or "meta" in index
+        old_ids = index.get("ids")
+        old_states = index.get("states")
+
+        index["version"] = STORE_VERSION
+        if "meta" in index:
+            del index["meta"]
+        index["ids"] = []
+
+        written = 0
+        states = {}
+        hot = {}
+        for entry in ufp["entries"]:
+            # Broken feeds can contain duplicates, only the first is kept.
+            if entry["id"] in states:
+                continue
+
+            states[entry["id"]] = entry["canto_state"]
+            entry = freeze(plain(entry))
+            del entry["canto_state"]
+            written += self.put_entry(entry, index)
+            index["ids"].append(entry["id"])
+            hot[entry["id"]] = dict([ (k, entry[k]) for k in HOT_FIELDS\
+                    if k in entry ])
+            if "link" not in entry and "href" in entry:
+                hot[entry["id"]]["link"] = entry["href"]
+
+        for id in index["digests"].keys():
+            if id not in states:
+                self.del_entry(index, id)
+                written += 1
+
+        for id, state in self.read_journal():
+            if id in states:
+                states[id] = state
+        index["states"] = states
+
+        meta = dict([(k, plain(v)) for (k, v) in ufp.items()\
+                if k != "entries" and k not in FETCH_KEYS])
+        fetched = dict([(k, plain(ufp[k])) for k in FETCH_KEYS if k in ufp])
+
+        old_meta = self.read_meta(index) or {}
+        for k in FETCH_KEYS:
+            if k in old_meta:
+                del old_meta[k]
+
+        changed = changed or written or index["ids"] != old_ids or\
+                states != old_states or meta != old_meta
+
+        self.write_fetched(fetched)
+        if changed:
+            self.write_meta(meta)
+            self.write_hot(hot)
+            self.write_index(index)
+            self.write_version()
+            open(self.path + "/state", "w").close()
+            self.touch()
+        return changed
+
+    # Upgrade performs the one-shot migration from a pre-0.7.11 pickle to a
+    # FeedStore() at the same path. Returns 1 if a migration was done.
+
+    def upgrade(self):
+        if not os.path.isfile(self.path):
+            return 0
+
+        f = open(self.path, "r")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+            # Someone else migrated it while we were waiting on the lock.
+            if not os.path.isfile(self.path):
+                return 0
+
+            ufp = loads(f.read())
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            f.close()
+
+        # The new store is built off to the side and then moved into place, so
+        # the old pickle isn't lost if anything goes wrong.
+
+        tmp = FeedStore(self.path + ".new")
+        if os.path.exists(tmp.path):
+            remove(tmp.path)
+        try:
+            tmp.save(ufp)
+            os.unlink(self.path)
+            os.rename(tmp.path, self.path)
+        except:
+            remove(tmp.path)
+            return 0
+        return 1
+
+    # Upgrade_schema rewrites a store older than STORE_VERSION in the current
+    # format, so that readers don't have to convert it every time. Returns 1
+    # if the store was rewritten.
+
+    # Stores written before the version file existed only have the version in
+    # the index, so that's read once, and the version file written if it's
+    # current.
+
+    def upgrade_schema(self):
+        if not self.exists() or self.read_version() == STORE_VERSION:
+            return 0
+
+        self.lock(fcntl.LOCK_EX)
+        try:
+            # Someone else upgraded it while we were waiting on the lock.
+            if self.read_version() == STORE_VERSION:
+                return 0
+
+            index = self.read_index()
+            if not index:
+                return 0
+
+            if index.get("version") == STORE_VERSION:
+                self.write_version()
+                return 0
+
+            ufp = self.load()
+            if not ufp:
+                return 0
+            self.save(ufp)
+        finally:
+            self.unlock()
+        return 1
+
+# Remove a feed from disk, regardless of format.
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
@@ -16,10 +16,16 @@
 # Story doesn't care which feed or tag it's associated with. If you really want
 # to get the feed, story["feed"] contains the unique URL, but you'd have to use
 # the config to get the Feed() object. The only thing that the Story() gets from
-# the feed is the get_ufp function that gets the feedparser dict from disk.
+# the feed is the path of its FeedStore(), to read its own entry from disk.
 
+# If canto-fetch is set to defer_sanitize, the story's content is stored as it
+# came in the feed, and is only sanitized (and has its relative URIs resolved)
+# when get_text() is first called. The result is kept, even by free().
+
+from feedparser_builtin import sanitizeDeferred
 from const import STORY_SAVED, STORY_UPDATED
-import cPickle
+from store import FeedStore, find_key
+import utility
 import fcntl
 
 class Story():
@@ -30,6 +36,10 @@ class Story():
         self.d = d
         self.sel = 0
         self.in_reader = 0
+        self.text = None
+
+        # Set by the Feed() that reads it in, see Feed.delta()
+        self.sid = None
     
     def __eq__(self, other):
         if self["id"] != other["id"]:
@@ -50,31 +60,23 @@ class Story():
         return self.d["title"] + " " + str(id(self))
 
     # Where get_ufp reads the ufp from disk, this narrows that down to a
-    # particular feed entry.
+    # particular feed entry, which is the only thing read off of the disk.
 
     def get_ufp_entry(self):
+        self.ondisk = None
         if not self.ufp_path:
-            return {}
+            return
 
+        store = FeedStore(self.ufp_path)
         try:
-            f = open(self.ufp_path, "r")
-            try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-                ufp = cPickle.load(f)
-            except:
-                return {}
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+            store.lock(fcntl.LOCK_SH)
         except:
-            return {}
+            return
 
-        for ondisk in ufp["entries"]:
-            if ondisk["id"] == self["id"]:
-                break
-        else:
-            self.ondisk = None
-        self.ondisk = ondisk
+        try:
+            self.ondisk = store.get_entry(self["id"])
+        finally:
+            store.unlock()
 
     def __getitem__(self, key):
         if key in self.d:
@@ -86,7 +88,8 @@ class Story():
                 self.get_ufp_entry()
             if not self.ondisk:
                 return ""
-            if key in self.ondisk:
+            key = find_key(self.ondisk, key)
+            if key:
                 return self.ondisk[key]
             return ""
 
@@ -101,7 +104,7 @@ class Story():
                 self.get_ufp_entry()
             if not self.ondisk:
                 return False
-            return key in self.ondisk
+            return find_key(self.ondisk, key) != None
 
     def was(self, tag):
         return tag in self.d["canto_state"]
@@ -129,12 +132,42 @@ class Story():
         self.sel = 0
 
     def get_text(self):
+        if self.text != None:
+            return self.text
+
+        text = None
+        detail = None
         if "content" in self:
             for c in self["content"]:
                 if "type" in c and "text" in c["type"]:
-                    return c["value"]
-
-        return self["description"]
+                    text = c["value"]
+                    detail = c
+                    break
+
+        if text == None:
+            text = self["description"]
+            if "summary_detail" in self:
+                detail = self["summary_detail"]
+
+            # Content that was copied into the description has no detail of
+            # its own.
+
+            if "content" in self:
+                for c in self["content"]:
+                    if c.get("value") == text:
+                        detail = c
+
+        if detail and detail.get("deferred"):
+            self.text = self.sanitize(text, detail.get("base"))
+            return self.text
+        return text
+
+    # Sanitize the raw content. The content has been through stripchars in
+    # canto-fetch, which has to be undone first, and redone after.
+
+    def sanitize(self, text, base):
+        text = list(utility.strip_escape_chars([text]))[0]
+        return utility.stripchars(sanitizeDeferred(text, base))
 
     def get_type(self):
         if "content" in self:
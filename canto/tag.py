@@ -77,16 +77,19 @@ class Tag(list):
                 list.insert(self, idx, item)
             return
 
-        added = 0
-        for i, item in enumerate(self):
-            while sort(item, iter[0][0]) > 0:
-                list.insert(self, i + added, iter[0][0])
-                del iter[0]
-                added += 1
-                if not iter:
-                    return
-
-        list.extend(self, [ item[0] for item in iter])
+        # Both are sorted, so merge them. Each new item goes before the first
+        # item that sorts after it.
+
+        new = [ item[0] for item in iter ]
+        merged = []
+        j = 0
+        for item in self:
+            while j < len(new) and sort(item, new[j]) > 0:
+                merged.append(new[j])
+                j += 1
+            merged.append(item)
+        merged.extend(new[j:])
+        self[:] = merged
 
     def retract(self, iter):
         for item in iter:
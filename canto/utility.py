@@ -91,7 +91,6 @@ def silentfork(path, href, text, fetch):
         sys.exit(0)
 
     if text:
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
         signal.signal(signal.SIGWINCH, signal.SIG_IGN)
 
     return pid
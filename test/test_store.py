@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Tests for the FeedStore(), run against an installed canto, e.g. with the
+# PYTHONPATH runhere.sh sets up:
+#
+#   python -m unittest discover test
+
+from canto.store import FeedStore
+import tempfile
+import unittest
+import shutil
+import time
+import os
+
+# What canto-fetch's process() hands to save() for an HTTP feed, including the
+# bits of the response feedparser keeps.
+
+def fetched(date, title=u"Story"):
+    return { "feed" : { "title" : u"Test" },
+             "version" : u"rss20",
+             "encoding" : u"utf-8",
+             "canto_state" : [],
+             "canto_update" : time.time(),
+             "canto_etag" : u"\"abc\"",
+             "headers" : { "date" : date, "etag" : u"\"abc\"" },
+             "status" : 200,
+             "href" : u"http://test.invalid/feed",
+             "etag" : u"\"abc\"",
+             "updated" : date,
+             "bozo" : 0,
+             "entries" : [{ "id" : u"urn:test:1",
+                            "title" : title,
+                            "link" : u"http://test.invalid/1",
+                            "canto_state" : [u"Test", u"*"] }] }
+
+class TestSave(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = FeedStore(self.dir + "/feed")
+        self.store.save(fetched(u"Mon, 01 Jan 2024 00:00:00 GMT"))
+
+        # Put the stamp well in the past, so any touch shows.
+        os.utime(self.store.path + "/lock", (1000, 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unchanged_refetch(self):
+        changed = self.store.save(fetched(u"Mon, 01 Jan 2024 00:00:02 GMT"))
+        self.assertFalse(changed)
+        self.assertEqual(self.store.stamp(), 1000)
+
+        # The response itself is still recorded.
+        meta = self.store.read_meta()
+        self.assertEqual(meta["headers"]["date"],
+                u"Mon, 01 Jan 2024 00:00:02 GMT")
+
+    def test_changed_refetch(self):
+        changed = self.store.save(fetched(u"Mon, 01 Jan 2024 00:00:02 GMT",
+            u"New title"))
+        self.assertTrue(changed)
+        self.assertNotEqual(self.store.stamp(), 1000)
+
+if __name__ == "__main__":
+    unittest.main()